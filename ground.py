@@ -0,0 +1,411 @@
+"""
+Topology optimization from a ground structure - every admissible member
+between a cloud of candidate joints - as a linear program over the forces in
+the members
+"""
+from collections import defaultdict, namedtuple
+import numpy as np
+import scipy
+import scipy.optimize
+import scipy.sparse
+import scipy.sparse.linalg
+
+from structure import Truss
+
+Layout = namedtuple('Layout', 'truss tensions cost iterations members')
+
+
+class GroundStructure(object):
+	"""
+	Every member which could join a set of candidate joints, for finding the
+	cheapest truss able to carry some forces.
+
+	`positions` is an (n_joints, dim) array, `mounts` a boolean mask of which
+	joints are mounts, and `names` optional names for the joints, as for
+	`Truss.from_arrays`. A member is admissible between any two joints no more
+	than `max_length` apart, unless both are mounts, or another joint lies on
+	the line between them - that member would be no better than the two
+	shorter ones, and only makes the program degenerate. Pass
+	`overlapping=True` to keep them.
+
+	`cost` is called with an array of member lengths, and returns arrays of
+	the cost per unit of tension and per unit of compression of each, such as
+	`sdp.get_member_costs`. A cost of inf forbids that sign of force.
+
+	The members are never all held in memory at once - they are generated in
+	chunks of about `chunk_size` whenever they are needed.
+	"""
+	def __init__(self, positions, mounts, cost, names=None, max_length=np.inf, overlapping=False, chunk_size=1 << 18):
+		self.joints = Truss.from_arrays(positions, np.zeros((0, 2), dtype=int), mounts, names)
+		self.positions = self.joints.positions
+		self.mounts = self.joints.mounts
+		self.cost = cost
+		self.max_length = max_length
+		self.overlapping = overlapping
+		self.chunk_size = chunk_size
+
+	def __repr__(self):
+		return "<GroundStructure: {} joints>".format(len(self.positions))
+
+	def members(self):
+		"""Yield the admissible members as (n, 2) arrays of joint indices"""
+		n = len(self.positions)
+		rows = max(1, self.chunk_size // n)
+		for start in range(0, n, rows):
+			a, b = np.nonzero(np.arange(start, min(start + rows, n))[:,np.newaxis] != np.arange(n))
+			a += start
+			keep = a < b
+			if not self.overlapping:
+				keep &= self._nearest(a, b)
+			keep &= ~(self.mounts[a] & self.mounts[b])
+			if np.isfinite(self.max_length):
+				keep &= self._lengths(a, b) <= self.max_length
+			yield np.stack([a[keep], b[keep]], axis=1)
+
+	def _nearest(self, a, b):
+		"""
+		Whether each b is the nearest joint to a in its direction from a, for
+		pairs grouped by a
+		"""
+		diff = self.positions[b] - self.positions[a]
+		lengths = np.linalg.norm(diff, axis=-1)
+		directions = np.round(diff / lengths[:,np.newaxis] * 1e9).astype(np.int64)
+		order = np.lexsort((lengths,) + tuple(directions.T) + (a,))
+		key = np.column_stack([a[order], directions[order]])
+		first = np.ones(len(order), dtype=bool)
+		first[1:] = (key[1:] != key[:-1]).any(axis=-1)
+		nearest = np.empty(len(order), dtype=bool)
+		nearest[order] = first
+		return nearest
+
+	def _lengths(self, a, b):
+		return np.linalg.norm(self.positions[b] - self.positions[a], axis=-1)
+
+	def optimize(self, forces, initial=1.5, tol=1e-4, max_add=None):
+		"""
+		Find the cheapest layout of members able to carry `forces`, a dict of
+		forces keyed by joint name. Returns a Layout of the truss of the members
+		used, their tensions in the order of its beams, the cost, the number of
+		linear programs solved, and the members as pairs of joint indices.
+
+		The first program only has the members no longer than `initial` times
+		the shortest, doubling that until the forces can be carried. After each
+		solve, the admissible members whose dual constraints are violated by a
+		factor of more than `1 + tol` are added, until none are. Only the worst
+		`max_add` are added at once, which defaults to as many as are already in
+		the program, so that it at most doubles in size. The duals come from
+		HiGHS, which arrived in scipy 1.7, or without it from the optimum of the
+		interior-point method - see `_basis_duals`.
+
+		The final layout drops members carrying less than `tol` of the largest
+		force, and joins members which meet in a straight line at a joint with
+		nothing else to brace it.
+		"""
+		dofs, rhs = self._equilibrium(forces)
+		cost = lambda members, lengths: self.cost(lengths)
+
+		shortest, longest = np.inf, 0
+		for chunk in self.members():
+			if len(chunk):
+				lengths = self._lengths(*chunk.T)
+				shortest = min(shortest, lengths.min())
+				longest = max(longest, lengths.max())
+		if not np.isfinite(shortest):
+			raise ValueError("No members are admissible")
+
+		limit = initial * shortest
+		iterations = 0
+		while True:
+			result = self._generate(self._shorter_than(limit), dofs, rhs, cost, tol, max_add)
+			if result is not None:
+				break
+			iterations += 1
+			if limit >= longest:
+				raise ValueError("No layout of the admissible members can carry the forces")
+			limit *= 2
+
+		active, tensions, value, solves = result
+		return self._layout(active, tensions, value, iterations + solves, dofs, rhs, tol)
+
+	def refine(self, layout, forces, member_cost, floor=0.5, iterations=10, tol=1e-4, max_add=None):
+		"""
+		Clean up a layout from `optimize` for member costs which are not linear
+		in the force, such as those of a catalogue of sections. There, a member
+		carrying a negligible force still costs as much as the smallest section,
+		so the linear costs leave many members which are cheap in the program
+		but not in reality.
+
+		`member_cost` is called with arrays of member lengths and tensions, and
+		returns the actual cost of each member, with inf where no member can
+		carry that tension. The program is solved again with each member priced
+		per unit force at its actual cost for the force it carried last time,
+		or `floor` times the largest applied force if that is more, so members
+		carrying little become expensive and drop out. This repeats until the
+		members stop changing, at most `iterations` times. Returns the Layout
+		with the lowest actual cost, whose `cost` is that of its program.
+		"""
+		dofs, rhs = self._equilibrium(forces)
+		floor *= max(np.linalg.norm(f) for f in forces.values())
+		n = len(self.positions)
+
+		def actual(layout):
+			return member_cost(layout.truss.lengths, layout.tensions).sum()
+
+		best, best_cost = layout, actual(layout)
+		for i in range(iterations):
+			keys = layout.members[:,0] * n + layout.members[:,1]
+			order = np.argsort(keys)
+			keys = keys[order]
+			carried = np.maximum(np.abs(layout.tensions[order]), floor)
+
+			def cost(members, lengths, keys=keys, carried=carried):
+				found = _find(keys, members[:,0] * n + members[:,1])
+				expected = np.where(found >= 0, carried[found], floor)
+				return (
+					member_cost(lengths, expected) / expected,
+					member_cost(lengths, -expected) / expected
+				)
+
+			active, tensions, value, solves = self._generate(layout.members, dofs, rhs, cost, tol, max_add)
+			refined = self._layout(active, tensions, value, layout.iterations + solves, dofs, rhs, tol)
+			refined_cost = actual(refined)
+			if refined_cost < best_cost:
+				best, best_cost = refined, refined_cost
+
+			# stop once the members settle
+			settled = np.array_equal(np.sort(refined.members[:,0] * n + refined.members[:,1]), keys)
+			layout = refined
+			if settled:
+				break
+
+		return best
+
+	def _equilibrium(self, forces):
+		"""The free degrees of freedom, and the right hand side of the program"""
+		n, dim = self.positions.shape
+		free = np.flatnonzero(~self.mounts)
+		dofs = (free[:,np.newaxis] * dim + np.arange(dim)).ravel()
+		rhs = -self.joints.forces_array(forces).ravel()[dofs]
+		return dofs, rhs
+
+	def _generate(self, active, dofs, rhs, cost, tol, max_add):
+		"""
+		Solve the program over `active`, adding members until no dual
+		constraints are violated. Returns the members, their tensions, the cost
+		and the number of programs solved, or None if `active` cannot carry the
+		forces.
+		"""
+		iterations = 0
+		while True:
+			iterations += 1
+			result = self._solve(active, dofs, rhs, cost)
+			if result is None:
+				return None
+
+			tensions, duals, value = result
+			added = self._violations(active, dofs, duals, cost, tol, len(active) if max_add is None else max_add)
+			if not len(added):
+				return active, tensions, value, iterations
+			active = np.concatenate([active, added])
+
+	def _layout(self, active, tensions, cost, iterations, dofs, rhs, tol):
+		used = np.abs(tensions) > tol * np.abs(tensions).max()
+		loaded = np.zeros(self.positions.size, dtype=bool)
+		loaded[dofs[rhs != 0]] = True
+		members, tensions = self._merge(active[used], tensions[used], loaded.reshape(self.positions.shape).any(axis=-1))
+		return Layout(self._truss(members), tensions, cost, iterations, members)
+
+	def _merge(self, members, tensions, loaded):
+		"""
+		Join members which meet end to end in a straight line at a joint with
+		nothing else attached and no force on it. That joint braces nothing, so
+		the pair is really one longer member, which buckles as one.
+		"""
+		members = [tuple(m) for m in members]
+		attached = defaultdict(set)
+		for i, (a, b) in enumerate(members):
+			attached[a].add(i)
+			attached[b].add(i)
+
+		for joint in list(attached):
+			if len(attached[joint]) != 2 or self.mounts[joint] or loaded[joint]:
+				continue
+			i, j = attached[joint]
+			far_i = sum(members[i]) - joint
+			far_j = sum(members[j]) - joint
+			u = self.positions[far_i] - self.positions[joint]
+			v = self.positions[far_j] - self.positions[joint]
+			if np.dot(u, v) > -(1 - 1e-9) * np.linalg.norm(u) * np.linalg.norm(v):
+				continue
+
+			members[i] = (min(far_i, far_j), max(far_i, far_j))
+			members[j] = None
+			attached[far_j].discard(j)
+			attached[far_j].add(i)
+			attached[joint] = set()
+
+		# a joined member may duplicate one already there
+		keep = [i for i, m in enumerate(members) if m is not None]
+		members, index = np.unique(np.array([members[i] for i in keep]).reshape(-1, 2), axis=0, return_inverse=True)
+		merged = np.zeros(len(members))
+		np.add.at(merged, index.ravel(), np.asarray(tensions)[keep])
+		return members, merged
+
+	def _shorter_than(self, limit):
+		return np.concatenate([
+			chunk[self._lengths(*chunk.T) <= limit] for chunk in self.members()
+		])
+
+	def _solve(self, members, dofs, rhs, cost):
+		"""
+		Solve the LP over the forces in some members, returning their tensions,
+		the duals of the equilibrium constraints, and the cost, or None if the
+		members cannot carry the forces
+		"""
+		n, dim = self.positions.shape
+		a, b = members.T
+		lengths = self._lengths(a, b)
+		directions = (self.positions[b] - self.positions[a]) / lengths[:,np.newaxis]
+
+		# rows of the equilibrium matrix for every dof, or -1 for mounts
+		rows = np.full(n * dim, -1)
+		rows[dofs] = np.arange(len(dofs))
+		a_rows = rows[a[:,np.newaxis] * dim + np.arange(dim)]
+		b_rows = rows[b[:,np.newaxis] * dim + np.arange(dim)]
+		cols = np.repeat(np.arange(len(members)), dim).reshape(-1, dim)
+		values = np.concatenate([directions[a_rows >= 0], -directions[b_rows >= 0]])
+		matrix = scipy.sparse.coo_matrix((
+			values, (
+				np.concatenate([a_rows[a_rows >= 0], b_rows[b_rows >= 0]]),
+				np.concatenate([cols[a_rows >= 0], cols[b_rows >= 0]])
+			)
+		), shape=(len(dofs), len(members))).tocsc()
+
+		# split each force into its tension and compression, dropping any
+		# which are forbidden
+		t_cost, c_cost = cost(members, lengths)
+		t_cols = np.flatnonzero(np.isfinite(t_cost))
+		c_cols = np.flatnonzero(np.isfinite(c_cost))
+		result = _linprog(
+			np.concatenate([t_cost[t_cols], c_cost[c_cols]]),
+			scipy.sparse.hstack([matrix[:,t_cols], -matrix[:,c_cols]]).tocsc(),
+			rhs
+		)
+		if result is None:
+			return None
+
+		x, duals, cost = result
+		tensions = np.zeros(len(members))
+		tensions[t_cols] += x[:len(t_cols)]
+		tensions[c_cols] -= x[len(t_cols):]
+		return tensions, duals, cost
+
+	def _violations(self, active, dofs, duals, cost, tol, max_add):
+		"""
+		Find the members not in `active` whose dual constraints are violated,
+		worst first
+		"""
+		n, dim = self.positions.shape
+		y = np.zeros(n * dim)
+		y[dofs] = duals
+		y = y.reshape(n, dim)
+		active_keys = np.sort(active[:,0] * n + active[:,1])
+
+		found, ratios = [], []
+		for chunk in self.members():
+			a, b = chunk.T
+			lengths = self._lengths(a, b)
+			directions = (self.positions[b] - self.positions[a]) / lengths[:,np.newaxis]
+			work = (directions * (y[a] - y[b])).sum(axis=-1)
+
+			# the work done by a unit force, over the cost of that force
+			t_cost, c_cost = cost(chunk, lengths)
+			ratio = np.maximum(work / t_cost, -work / c_cost)
+			violated = ratio > 1 + tol
+			violated[violated] = ~_contains(active_keys, a[violated] * n + b[violated])
+
+			found.append(chunk[violated])
+			ratios.append(ratio[violated])
+
+		found, ratios = np.concatenate(found), np.concatenate(ratios)
+		order = np.argsort(-ratios, kind='mergesort')[:max_add]
+		return found[order]
+
+	def _truss(self, members):
+		"""A CompiledTruss of some members, and the joints they use"""
+		used = np.unique(members)
+		index = np.full(len(self.positions), -1)
+		index[used] = np.arange(len(used))
+		names = self.joints.names
+		return Truss.from_arrays(
+			self.positions[used], index[members], self.mounts[used], [names[i] for i in used]
+		)
+
+
+def _find(sorted_keys, keys):
+	"""The index of each key in a sorted array of keys, or -1 if it is not there"""
+	if not len(sorted_keys):
+		return np.full(len(keys), -1)
+	i = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+	return np.where(sorted_keys[i] == keys, i, -1)
+
+def _contains(sorted_keys, keys):
+	"""Whether each key is in a sorted array of keys"""
+	return _find(sorted_keys, keys) >= 0
+
+def _linprog(cost, matrix, rhs):
+	"""
+	Minimize cost . x subject to matrix . x = rhs and x >= 0, returning x, the
+	duals of the constraints, and the cost, or None if it is infeasible
+	"""
+	# member costs are tiny next to the forces, so solve a problem of unit
+	# scale on both sides
+	cost_scale = np.abs(cost).max() if len(cost) else 1
+	rhs_scale = np.abs(rhs).max() or 1
+	cost, rhs = cost / cost_scale, rhs / rhs_scale
+
+	if _has_highs:
+		result = scipy.optimize.linprog(cost, A_eq=matrix, b_eq=rhs, bounds=(0, None), method='highs-ipm')
+	else:
+		result = scipy.optimize.linprog(cost, A_eq=matrix, b_eq=rhs, bounds=(0, None), method='interior-point', options=dict(sparse=True))
+
+	if result.status == 2:
+		return None
+	if result.status != 0:
+		raise ValueError(result.message)
+	if _has_highs:
+		duals = result.eqlin.marginals
+	else:
+		duals = _basis_duals(cost, matrix, result.x)
+	return result.x * rhs_scale, duals * cost_scale, result.fun * cost_scale * rhs_scale
+
+def _basis_duals(cost, matrix, x):
+	"""
+	The duals of the constraints at an optimum x, for scipy without HiGHS,
+	whose linprog does not return them.
+
+	Complementary slackness makes matrix[:,B].T . y = cost[B] over the basis
+	B, the columns with x > 0. This finds y by least squares weighted by x,
+	minimizing |X^1/2 (cost - matrix.T . y)|, whose normal equations are only
+	as big as the number of constraints. The interior-point method leaves the
+	rest of x small but not zero, so the basis is held to its costs, and the
+	other columns only settle the duals that the basis leaves free, such as
+	those of joints that no used member reaches. Without them, those duals
+	would be zero, and wrongly price the members there.
+	"""
+	weights = scipy.sparse.diags(np.maximum(x, 0))
+	normal = matrix.dot(weights).dot(matrix.T).tocsc()
+	rhs = matrix.dot(weights.dot(cost))
+	try:
+		return scipy.sparse.linalg.splu(normal).solve(rhs)
+	except RuntimeError:
+		pass
+
+	# the columns do not settle every dual, such as at a joint with only one
+	# member, so damp each slightly, leaving those with no columns at zero
+	diagonal = normal.diagonal()
+	normal = normal + scipy.sparse.diags(np.where(diagonal > 0, 1e-10 * diagonal, 1))
+	return scipy.sparse.linalg.splu(normal.tocsc()).solve(rhs)
+
+# HiGHS, and the duals from it, arrived in scipy 1.7
+_has_highs = tuple(int(v) for v in scipy.__version__.split('.')[:2]) >= (1, 7)
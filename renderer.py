@@ -1,21 +1,71 @@
 from contextlib import contextmanager
+import multiprocessing
 
 import numpy as np
 import math
 
 import structure
 
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
 class Renderer(object):
-	def __init__(self, obj, **kwargs):
+	def __init__(self, obj=None, **kwargs):
 		if isinstance(obj, structure.Loading):
 			self._draw_loading(obj, **kwargs)
-		elif isinstance(obj, structure.Truss):
+		elif isinstance(obj, (structure.Truss, structure.CompiledTruss)):
 			self._draw_structure(obj, **kwargs)
 
+	@staticmethod
+	def _compiled(st):
+		if isinstance(st, structure.CompiledTruss):
+			return st
+		return st.compile()
+
+
+class LabelPolicy(object):
+	"""
+	Which beams of a render to label, as a level of detail. A beam is labelled
+	if the size of its tension is at least `min_tension`, if it is one of the
+	`top` largest in size, or if it is at least `min_length` pixels long on
+	screen - so zooming in labels more of them. Either way, only beams with
+	their middle in view are labelled, along with the joints at their ends.
+	"""
+	def __init__(self, min_tension=None, top=None, min_length=None):
+		self.min_tension = min_tension
+		self.top = top
+		self.min_length = min_length
+
+	def __repr__(self):
+		return "LabelPolicy(min_tension={s.min_tension!r}, top={s.top!r}, min_length={s.min_length!r})".format(s=self)
+
+	def select(self, tensions, screen_lengths):
+		"""
+		Which beams to label, given their tensions, or None if there are none,
+		and their lengths on screen
+		"""
+		selected = np.zeros(len(screen_lengths), dtype=bool)
+		if tensions is not None:
+			size = abs(tensions)
+			if self.min_tension is not None:
+				selected |= size >= self.min_tension
+			if self.top:
+				selected[np.argsort(-size, kind='mergesort')[:self.top]] = True
+		if self.min_length is not None:
+			selected |= screen_lengths >= self.min_length
+		return selected
+
 try:
 	import matplotlib
-	import matplotlib.pyplot
-	from mpl_toolkits.mplot3d import Axes3D
+	import matplotlib.cm
+	import matplotlib.collections
+	import matplotlib.colors
+	import matplotlib.figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	from mpl_toolkits.mplot3d import Axes3D, proj3d
+	from mpl_toolkits.mplot3d.art3d import Line3DCollection
 except ImportError:
 	pass
 else:
@@ -34,82 +84,248 @@ else:
 				getattr(ax, 'set_{}lim'.format(dim))(ctr - r, ctr + r)
 
 		@contextmanager
-		def _make_plot(self, st, w=16, h=8, setup=lambda ax: None):
-			fig = matplotlib.pyplot.figure(figsize=np.array([w, h])/2.54, dpi=100)
-			fig.figurePatch.set_alpha(0)
-			if st.dimensions == 3:
-				ax = fig.add_subplot(1, 1, 1, projection='3d')
+		def _make_plot(self, st, w=16, h=8, setup=lambda ax: None, figure=None, labels=None):
+			"""
+			Set up an axis to draw on. By default this is in a new pyplot window,
+			which is shown once drawn. Given a `figure`, such as an
+			`offscreen_figure`, draws on that instead, reusing its axis if it
+			already has one of the right kind, and shows nothing.
+
+			Every beam and joint is labelled, unless `labels` is a LabelPolicy,
+			in which case the labels follow it, and are chosen again whenever
+			the limits of the axis change.
+			"""
+			if figure is None:
+				import matplotlib.pyplot
+				fig = matplotlib.pyplot.figure(figsize=np.array([w, h])/2.54, dpi=100)
+			else:
+				fig = figure
+				fig.set_size_inches(np.array([w, h])/2.54)
+			fig.patch.set_alpha(0)
+
+			projection = '3d' if st.dimensions == 3 else 'rectilinear'
+			axes = fig.get_axes()
+			if len(axes) == 1 and axes[0].name == projection:
+				ax = axes[0]
+				for cid in getattr(ax, '_label_callbacks', []):
+					ax.callbacks.disconnect(cid)
+				ax.cla()
 			else:
-				ax = fig.add_subplot(1, 1, 1)
+				fig.clf()
+				ax = fig.add_subplot(1, 1, 1, projection=projection)
+			if st.dimensions != 3:
 				ax.margins(0.1, 0.1)
 			setup(ax)
 			ax.grid()
 
 			self.dimensions = st.dimensions
 			self.axis = ax
+			self.structure = st
+			self.label_policy = labels
+			self._beam_labels = None
+			self._tensions = None
+			self._label_artists = []
 			yield
 
 			if st.dimensions == 3:
 				self.axisEqual3D(ax)
 			else:
 				ax.set_aspect('equal')
-			matplotlib.pyplot.show()
+
+			self._update_labels()
+			if labels is not None:
+				# matplotlib only keeps weak references to bound methods
+				def update(ax):
+					self._update_labels()
+				events = ['xlim_changed', 'ylim_changed'] + (['zlim_changed'] if st.dimensions == 3 else [])
+				ax._label_callbacks = [ax.callbacks.connect(e, update) for e in events]
+
+			if figure is None:
+				matplotlib.pyplot.show()
 
 		def _draw_structure(self, st, **kwargs):
+			st = self._compiled(st)
 			with self._make_plot(st, **kwargs):
-				for b in st.beams:
-					self._draw_beam(b)
-
-				for j in st.joints:
-					self._draw_joint(j)
+				self._draw_beams(st, colors='r')
+				self._draw_joints(st)
 
 
 		def _draw_loading(self, l, **kwargs):
-			limit = max(abs(t) for t in l.tensions.values())
+			st = self._compiled(l.structure)
+			tensions = np.array([l.tensions[beam] for beam in st.beams], dtype=float)
+			self._draw_tensions(st, tensions, **kwargs)
+
+		def _draw_tensions(self, st, tensions, **kwargs):
+			limit = abs(tensions).max() if len(tensions) else 0
 			color_mapping = matplotlib.cm.ScalarMappable(
 				norm=matplotlib.colors.Normalize(vmin=-limit, vmax=limit),
 				cmap=matplotlib.cm.RdYlGn
 			)
 
-			st = l.structure
 			with self._make_plot(st, **kwargs):
-				for b in st.beams:
-					t = l.tensions[b]
-					self._draw_beam(b, text='{:.0f}'.format(t), color=color_mapping.to_rgba(t))
+				self._draw_beams(
+					st,
+					colors=color_mapping.to_rgba(tensions),
+					labels=['{:.0f}'.format(t) for t in tensions],
+					tensions=tensions
+				)
+				self._draw_joints(st)
 
-				for j in st.joints:
-					self._draw_joint(j)
+		def _draw_beams(self, st, colors, labels=None, tensions=None):
+			"""
+			Draw every beam of a compiled truss as one collection of lines. The
+			labels are added once the plot is set up.
+			"""
+			segments = st.positions[st.connectivity]
+			if self.dimensions == 3:
+				self.axis.add_collection3d(Line3DCollection(segments, colors=colors))
+			else:
+				self.axis.add_collection(matplotlib.collections.LineCollection(segments, colors=colors))
 
-		def _draw_beam(self, beam, color='r', text=None):
-			self.axis.plot(
-				*zip(beam.a.pos, beam.b.pos),
-				color=color
-			)
-			if text is not None:
-				if self.dimensions == 2:
-					self.axis.annotate(
-						text,
-						xy=(beam.a.pos + beam.b.pos) / 2,
-						textcoords='offset points',
-						xytext=[-2*beam.direction[1], 2*beam.direction[0]],
-						rotation=math.degrees(math.atan2(beam.direction[1], beam.direction[0])),
-						color='black',
-						va='bottom',
-						ha='center',
-						fontsize=11
+			self._beam_labels = labels
+			self._tensions = tensions
+
+		def _draw_joints(self, st):
+			"""Draw every joint of a compiled truss as one scatter"""
+			self.axis.scatter(*st.positions.T, color='black', s=4)
+
+		def _screen_positions(self):
+			"""The positions of the joints in pixels"""
+			ax = self.axis
+			positions = self.structure.positions
+			if self.dimensions == 3:
+				x, y, _ = proj3d.proj_transform(*positions.T, M=ax.get_proj())
+				positions = np.stack([x, y], axis=-1)
+			else:
+				ax.apply_aspect()
+			return ax.transData.transform(positions)
+
+		def _update_labels(self):
+			"""Replace the labels with those the label policy picks for the current view"""
+			for artist in self._label_artists:
+				artist.remove()
+
+			st = self.structure
+			beams = np.ones(len(st.connectivity), dtype=bool)
+			joints = np.ones(len(st.positions), dtype=bool)
+			if self.label_policy is not None:
+				screen = self._screen_positions()
+				a, b = st.connectivity.T
+				x0, y0, x1, y1 = self.axis.bbox.extents
+				middles = (screen[a] + screen[b]) / 2
+				in_view = (
+					(middles[:,0] >= x0) & (middles[:,0] <= x1) &
+					(middles[:,1] >= y0) & (middles[:,1] <= y1)
+				)
+				beams = in_view & self.label_policy.select(
+					self._tensions, np.linalg.norm(screen[b] - screen[a], axis=-1)
+				)
+				joints[:] = False
+				joints[st.connectivity[beams].ravel()] = True
+
+			self._label_artists = []
+			if self._beam_labels is not None:
+				for i in np.flatnonzero(beams):
+					a, b = st.connectivity[i]
+					self._label_artists.append(
+						self._label_beam(st.positions[a], st.positions[b], self._beam_labels[i])
 					)
-				else:
-					self.axis.text(*(beam.a.pos + beam.b.pos) / 2, s=text)
+			for i in np.flatnonzero(joints):
+				self._label_artists.append(self._label_joint(st.names[i], st.positions[i]))
+
+		def _label_beam(self, a_pos, b_pos, text):
+			if self.dimensions == 2:
+				direction = (b_pos - a_pos) / np.linalg.norm(b_pos - a_pos)
+				return self.axis.annotate(
+					text,
+					xy=(a_pos + b_pos) / 2,
+					textcoords='offset points',
+					xytext=[-2*direction[1], 2*direction[0]],
+					rotation=math.degrees(math.atan2(direction[1], direction[0])),
+					color='black',
+					va='bottom',
+					ha='center',
+					fontsize=11
+				)
+			else:
+				return self.axis.text(*(a_pos + b_pos) / 2, s=text)
 
-		def _draw_joint(self, joint):
+		def _label_joint(self, name, pos):
 			if self.dimensions == 2:
-				self.axis.annotate(
-					joint.name,
-					xy=joint.pos,
+				return self.axis.annotate(
+					name,
+					xy=pos,
 					color='black',
 					va='center',
 					ha='center',
 					fontsize=11
 				)
 			else:
-				self.axis.text(*joint.pos, s=joint.name)
\ No newline at end of file
+				return self.axis.text(*pos, s=name)
+
+
+	def offscreen_figure():
+		"""A figure drawn by the Agg canvas, without pyplot or a display"""
+		fig = matplotlib.figure.Figure()
+		FigureCanvasAgg(fig)
+		return fig
+
+	def render_file(obj, filename, figure=None, **kwargs):
+		"""
+		Render a `Truss` or `Loading` off-screen to an image file, in the
+		format given by its extension. `figure` is drawn on if given, else a
+		new `offscreen_figure`.
+		"""
+		if figure is None:
+			figure = offscreen_figure()
+		MPLRenderer(obj, figure=figure, **kwargs)
+		figure.savefig(filename)
+
+	def render_files(objs, filenames, workers=None, **kwargs):
+		"""
+		Render many `Truss` and `Loading` objects off-screen, each to the file
+		of the same index, spread over a pool of processes. Each process
+		draws every design it is given on the same figure.
+
+		Only the arrays of each design are sent to the processes. With
+		`workers=1`, or without concurrent.futures, renders in this process.
+		"""
+		if workers is None:
+			workers = multiprocessing.cpu_count()
+		designs = [_design(obj) for obj in objs]
+		filenames = list(filenames)
+
+		if workers == 1 or ProcessPoolExecutor is None:
+			for design, filename in zip(designs, filenames):
+				_render_design(design, filename, kwargs)
+		else:
+			pool = ProcessPoolExecutor(workers)
+			try:
+				list(pool.map(_render_design, designs, filenames, [kwargs] * len(designs)))
+			finally:
+				pool.shutdown()
+
+	def _design(obj):
+		"""The arrays needed to draw a `Truss` or `Loading`"""
+		if isinstance(obj, structure.Loading):
+			st = Renderer._compiled(obj.structure)
+			tensions = np.array([obj.tensions[beam] for beam in st.beams], dtype=float)
+		else:
+			st = Renderer._compiled(obj)
+			tensions = None
+		return structure.Truss.from_arrays(st.positions, st.connectivity, st.mounts, st.names), tensions
+
+	# the figure reused by this worker process
+	_figure = None
+
+	def _render_design(design, filename, kwargs):
+		global _figure
+		if _figure is None:
+			_figure = offscreen_figure()
+
+		st, tensions = design
+		if tensions is None:
+			MPLRenderer()._draw_structure(st, figure=_figure, **kwargs)
+		else:
+			MPLRenderer()._draw_tensions(st, tensions, figure=_figure, **kwargs)
+		_figure.savefig(filename)
\ No newline at end of file
@@ -1,8 +1,9 @@
-import itertools
 import math
 
-from structure import Joint, Mount, Beam, Truss, Loading, NotStaticallyDeterminate
+from structure import Joint, Mount, Beam, Truss, Loading
 from renderer import MPLRenderer as display
+from sweep import Sweep, optimize
+from ground import GroundStructure
 
 import sections
 
@@ -18,8 +19,7 @@ def show_cost(loading):
 
 			print beam, ':', name
 		else:
-			b = sections.beams["1"]
-			c_cost += l * b.linear_density * 500
+			c_cost += l * sections.catalogue.tension_cost
 
 	print "Cost:", c_cost
 
@@ -58,21 +58,108 @@ def show_cost(loading):
 	axc.figure.savefig('beams.png')
 	axt.figure.savefig('dumbbeams.png')
 
-def get_cost(loading):
-	c_cost = 0
+def get_cost(loading, bound=np.inf, catalogue=sections.catalogue):
+	"""
+	The cost of the beams of a loaded structure, using sections from
+	`catalogue`. If it is known to be more than `bound` before all the
+	sections have been chosen, returns inf.
+
+	Symmetric loadings only choose sections for one beam of each mirror pair.
+	"""
+	if loading.mirrored:
+		beams = list(loading.mirrored)
+		copies = np.array([loading.mirrored[beam] for beam in beams])
+	else:
+		beams = list(loading.tensions)
+		copies = 1
+	lengths = np.array([beam.length for beam in beams])
+	tensions = np.array([loading.tensions[beam] for beam in beams])
+
+	# tension members cost the same whatever their tension, so bound the cost
+	# with the cheapest section for each compression member first
+	costs_l = np.where(tensions < 0, catalogue.costs.min(), catalogue.tension_cost)
+	if (copies * lengths / 1000 * costs_l).sum() > bound:
+		return float('inf')
+
+	costs, names = get_costs(lengths, tensions, copies, catalogue)
+	return costs[()]
+
+def get_cost_bound(lengths, catalogue=sections.catalogue):
+	"""
+	A lower bound on get_cost from the lengths of the beams alone, for pruning
+	a Sweep
+	"""
+	cost_l = min(catalogue.costs.min(), catalogue.tension_cost)
+	return (np.asarray(lengths) / 1000).sum(axis=-1) * cost_l
+
+def get_member_costs(lengths, catalogue=sections.catalogue):
+	"""
+	The cost per unit of tension and per unit of compression of members of
+	each length, for a GroundStructure. Compression is priced by
+	`Catalogue.cost_per_force`, and tension by the catalogue's tension section
+	loaded to its capacity, so that both are linear in the force.
+	"""
+	lengths = np.asarray(lengths, dtype=float)
+	tension = lengths / 1000 * catalogue.tension_cost / catalogue.tension_capacity
+	compression = lengths / 1000 * catalogue.cost_per_force(lengths)
+	return tension, compression
+
+def get_costs(lengths, tensions, copies=1, catalogue=sections.catalogue):
+	"""
+	The cost of many designs at once, from arrays of the lengths and tensions
+	of their beams, of shape (..., n_beams) - such as those of a BatchLoading.
+	`copies` is the number of identical beams each entry stands for.
+
+	Returns an array of costs, which are inf where a compression member is too
+	long or too heavily loaded for any section, or where the design could not
+	be solved, and an object array of the section from `catalogue` used for
+	each beam. Tension members all use its `tension_section`, and beams with
+	no section are None.
+	"""
+	lengths = np.asarray(lengths, dtype=float)
+	tensions = np.asarray(tensions, dtype=float)
+
+	names = np.full(tensions.shape, catalogue.tension_section, dtype=object)
+	costs_l = np.full(tensions.shape, catalogue.tension_cost)
+
+	compression = tensions < 0
+	names[compression], costs_l[compression] = catalogue.best_sections(
+		lengths[compression], -tensions[compression]
+	)
+
+	unsolved = np.isnan(tensions)
+	names[unsolved] = None
+	costs_l[unsolved] = np.inf
+
+	return (copies * lengths / 1000 * costs_l).sum(axis=-1), names
+
+def get_beam_costs(lengths, tensions, catalogue=sections.catalogue):
+	"""
+	The cost of each beam on its own, from arrays of their lengths and
+	tensions, for GroundStructure.refine
+	"""
+	costs, names = get_costs(
+		np.asarray(lengths)[:,np.newaxis], np.asarray(tensions)[:,np.newaxis], catalogue=catalogue
+	)
+	return costs
+
+def get_weight(loading):
+	"""
+	A smooth stand-in for get_cost, suitable for gradient-based optimization:
+	the sum of |tension| * length over all the beams, which is proportional to
+	the weight of a fully-stressed design. Returns the weight, and a dict of
+	its gradient with respect to the position of each joint.
+	"""
+	weight = 0
+	dJ_dt = {}
+	dJ_dx = {}
 	for beam, tension in loading.tensions.iteritems():
-		l = beam.length / 1000
-		if tension < 0:
-			try:
-				name, cost_l = sections.best_section(beam.length, -tension)
-			except ValueError:
-				return float('inf')
-			c_cost += l * cost_l
-		else:
-			b = sections.beams["1"]
-			c_cost += l * b.linear_density * 500
+		weight += abs(tension) * beam.length
+		dJ_dt[beam] = np.sign(tension) * beam.length
+		dJ_dx[beam.b] = dJ_dx.get(beam.b, 0) + abs(tension) * beam.direction
+		dJ_dx[beam.a] = dJ_dx.get(beam.a, 0) - abs(tension) * beam.direction
 
-	return c_cost
+	return weight, loading.gradient(dJ_dt, dJ_dx)
 
 def make_half():
 	a = Mount('A', np.array([   0.,    0.]))
@@ -250,7 +337,7 @@ def test_ridiculous3D():
 	Beam(a_, c_)
 	Beam(b, c)
 	Beam(b, c_)
-	# Beam(c, c_)
+	Beam(c, c_)
 	Beam(a, d)
 	Beam(a_, d)
 	Beam(c, d)
@@ -262,11 +349,14 @@ def test_ridiculous3D():
 	st = Truss(a)
 	display(st)
 
-	l = Loading(st, {e: [0, 0, -2000]})
+	# without the brace between C and C' this is a mechanism. With it, the
+	# truss is determinate, but no joint can be solved on its own, so solve
+	# every joint at once
+	l = Loading(st, {e: [0, 0, -2000]}, method='global')
 	show_cost(l)
 	display(l)
 
-def optimize_normal():
+def optimize_normal(adaptive=False, store=None):
 	a = Mount('A', np.array([   0.,    0.]))
 	b = Mount('B', np.array([   0.,  254.]))
 	c = Joint('C', np.array([ 451.,    0.]))
@@ -284,37 +374,28 @@ def optimize_normal():
 
 	load = {e: [0, -1000]}
 
-	best_f = float('inf')
-	best = []
-
-	# list of vector offsets to try over [-400, 400]^2
-	d_poses = d.pos + np.mgrid[-5:5:21j, -5:5:21j].T.reshape(-1, 2)
-	c_poses = c.pos + np.r_[1, 0] * np.r_[-5:5:21j][:, np.newaxis]
-	# c_poses = c.pos + np.mgrid[-400:400:20j, -400:400:20j].T.reshape(-1, 2)
-
-	print "tests"
-
-	for d_pos, c_pos in itertools.product(d_poses, c_poses):
-		d.pos = d_pos
-		c.pos = c_pos
-		try:
-			s = Loading(st, load)
-		except NotStaticallyDeterminate:
-			pass
+	if adaptive:
+		# refine over the same box as the grid below, with C fixed vertically
+		cost, poses = optimize(st, load, {
+			d: (d.pos - 5, d.pos + 5),
+			c: (c.pos - [5, 0], c.pos + [5, 0])
+		}, get_cost, lower_bound=get_cost_bound)
+		best = [(cost, poses)]
+	else:
+		# list of vector offsets to try over [-400, 400]^2
+		d_poses = d.pos + np.mgrid[-5:5:21j, -5:5:21j].T.reshape(-1, 2)
+		c_poses = c.pos + np.r_[1, 0] * np.r_[-5:5:21j][:, np.newaxis]
+		# c_poses = c.pos + np.mgrid[-400:400:20j, -400:400:20j].T.reshape(-1, 2)
 
-		max_f = get_cost(s)
+		print "tests"
 
-		if max_f < best_f:
-			best_f = max_f
-			best = [(d_pos, c_pos)]
-		elif max_f == best_f:
-			best_f = max_f
-			best.append((d_pos, c_pos))
+		best = Sweep(st, load, {d: d_poses, c: c_poses}, get_cost, get_cost_bound).run(k=10, store=store)
 
-	print best[:10]
+	for cost, poses in best:
+		print cost, poses[d], poses[c]
 
-	d.pos = best[0][0]
-	c.pos = best[0][1]
+	d.pos = best[0][1][d]
+	c.pos = best[0][1][c]
 	for j in st.joints:
 		print j
 	s = Loading(st, load)
@@ -323,4 +404,43 @@ def optimize_normal():
 	display(s)
 
 
-test_normal3D()
\ No newline at end of file
+def optimize_ground(spacing=65.):
+	"""
+	Find the layout for the load of optimize_normal from a grid of candidate
+	joints, rather than a fixed topology. The layout is then refined for the
+	actual costs of the sections, and solved again to price it.
+	"""
+	xs, ys = np.meshgrid(
+		np.linspace(0, 910, int(round(910 / spacing)) + 1),
+		np.linspace(0, 254, int(round(254 / spacing)) + 1),
+		indexing='ij'
+	)
+	positions = np.stack([xs.ravel(), ys.ravel()], axis=-1)
+	mounts = (positions[:,0] == 0) & ((positions[:,1] == 0) | (positions[:,1] == 254))
+	names = ['J{}'.format(i) for i in range(len(positions))]
+	e = np.flatnonzero((positions[:,0] == 910) & (positions[:,1] == 0))[0]
+
+	ground = GroundStructure(positions, mounts, get_member_costs, names=names)
+	load = {names[e]: [0, -1000]}
+	layout = ground.optimize(load)
+	print "LP cost:", layout.cost, "after", layout.iterations, "solves"
+	print "Actual cost:", get_beam_costs(layout.truss.lengths, layout.tensions).sum()
+
+	# the linear costs leave many lightly loaded members, which each cost at
+	# least the smallest section
+	layout = ground.refine(layout, load, get_beam_costs)
+	print "Refined LP cost:", layout.cost, "after", layout.iterations, "solves"
+
+	truss = layout.truss
+	l = Loading(truss, load)
+	tensions = np.array([l.tensions[beam] for beam in truss.beams])
+	costs, sections_used = get_costs(truss.lengths, tensions)
+	print "Actual cost:", costs[()]
+	for beam, tension, section in zip(truss.beams, tensions, sections_used):
+		print beam, tension, section
+
+	return layout
+
+
+if __name__ == '__main__':
+	test_normal3D()
\ No newline at end of file
@@ -1,4 +1,10 @@
 from collections import namedtuple
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 import numpy as np
 
 BeamCrossSection = namedtuple('BeamCrossSection', 'b t area linear_density color')
@@ -91,34 +97,390 @@ for mname, mode in modes.iteritems():
 		)
 
 
-def is_below(xs, ys, x, y):
-	for xa, xb, ya, yb in zip(xs[:-1], xs[1:], ys[:-1], ys[1:]):
-		if xa < x < xb:
-			y_pred = ya + (yb - ya) * (x - xa) / (xb - xa)
+def _compile_envelope(xs, ys):
+	xs = np.asarray(xs, dtype=float)
+	ys = np.asarray(ys, dtype=float)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		slopes = np.diff(ys) / np.diff(xs)
+	return xs, ys, slopes
 
-			return y < y_pred
 
-	return False
+def _segments(envelope, x):
+	"""
+	Find the segment of the envelope above each x, or -1 outside of it. Points
+	exactly on a vertex of the envelope are treated as outside, like `is_below`.
+	"""
+	xs, ys, slopes = envelope
+	x = np.asarray(x, dtype=float)
 
-def valid_sections(length, force):
-	for mname, mode in modes.iteritems():
-		for bname, beam in beams.iteritems():
+	i = np.searchsorted(xs, x)
+	inside = (i > 0) & (i < len(xs))
+	i = np.clip(i, 1, len(xs) - 1)
+	inside &= xs[i] != x
+
+	return np.where(inside, i - 1, -1)
+
+def _limits(envelope, x):
+	"""Interpolate the envelope at each x, giving -inf outside of it"""
+	xs, ys, slopes = envelope
+	i = _segments(envelope, x)
+	with np.errstate(invalid='ignore'):
+		return np.where(i >= 0, ys[i] + slopes[i] * (x - xs[i]), -np.inf)
+
+
+class SectionIndex(object):
+	"""
+	The cheapest section able to carry each force at each length, as a
+	piecewise map over the (length, force) plane.
+
+	The lengths are split at every vertex of every envelope, and at every point
+	where the set of sections which are stronger than all cheaper sections
+	changes. Row 2j of the map is then the open interval below breaks[j], and
+	row 2j + 1 the point breaks[j]. Each row stores that staircase of sections
+	in order of cost, which is also their order of strength, as indices into the
+	segments of all the envelopes. A lookup is a binary search for the first
+	segment above the force.
+	"""
+	def __init__(self, breaks, steps, xs, ys, slopes, owners):
+		self.breaks = breaks
+		self.steps = steps
+		self.xs = xs
+		self.ys = ys
+		self.slopes = slopes
+		self.owners = owners
+
+	def _limits(self, segments, x):
+		return self.ys[segments] + self.slopes[segments] * (x - self.xs[segments])
+
+	@classmethod
+	def build(cls, costs, envelopes, chunk=256):
+		costs = np.asarray(costs)
+		by_cost = np.argsort(costs, kind='mergesort')
+
+		# all the envelopes end to end, followed by a segment at -inf for outside
+		# an envelope, and one at +inf to pad the staircases
+		sizes = [len(xs) for xs, ys, slopes in envelopes]
+		offsets = np.cumsum([0] + sizes)[by_cost]
+		outside, padding = sum(sizes), sum(sizes) + 1
+		index = cls(
+			None, None,
+			np.concatenate([xs for xs, ys, slopes in envelopes] + [[0, 0]]),
+			np.concatenate([ys for xs, ys, slopes in envelopes] + [[-np.inf, np.inf]]),
+			np.concatenate([np.append(slopes, np.nan) for xs, ys, slopes in envelopes] + [[0, 0]]),
+			np.concatenate([np.full(n, i) for i, n in enumerate(sizes)] + [[-1, -1]]).astype(np.int32)
+		)
+
+		def segments(x):
+			"""The segments of each envelope above each x, in order of cost"""
+			i = np.stack([_segments(envelopes[s], x) for s in by_cost], axis=-1)
+			return np.where(i >= 0, i + offsets, outside)
+
+		xs = np.unique(index.xs[:-2])
+
+		# Between vertices every limit is a line. A section can only join the
+		# staircase where it rises above all the cheaper ones, so a section which
+		# nowhere exceeds the lowest point of a cheaper line is never on it, and
+		# only crossings between the others need splitting at.
+		breaks = [xs]
+		for start in range(0, len(xs) - 1, chunk):
+			lo = xs[start:start+chunk+1][:-1,np.newaxis]
+			hi = xs[start+1:start+chunk+1][:,np.newaxis]
+			seg = segments(((lo + hi) / 2)[:,0])
+			at_lo = index._limits(seg, lo)
+			at_hi = index._limits(seg, hi)
+			lowest = np.maximum.accumulate(np.minimum(at_lo, at_hi), axis=-1)
+			lowest = np.hstack([np.full((len(lo), 1), -np.inf), lowest[:,:-1]])
+			candidates = np.maximum(at_lo, at_hi) > lowest
+
+			for i in np.flatnonzero(candidates.sum(axis=-1) > 1):
+				c = seg[i, candidates[i], np.newaxis]
+				xa, ya, sa = index.xs[c], index.ys[c], index.slopes[c]
+				xb, yb, sb = xa.T, ya.T, sa.T
+				with np.errstate(divide='ignore', invalid='ignore'):
+					x = (yb - ya + sa * xa - sb * xb) / (sa - sb)
+					breaks.append(x[(lo[i] < x) & (x < hi[i])])
+		breaks = np.unique(np.concatenate(breaks))
+
+		# one sample within each row
+		samples = np.empty(2 * len(breaks) + 1)
+		samples[1::2] = breaks
+		samples[2:-1:2] = (breaks[:-1] + breaks[1:]) / 2
+		samples[0] = breaks[0] - 1
+		samples[-1] = breaks[-1] + 1
+
+		# the staircase in each row, taking the first section on a tie
+		rows = []
+		for start in range(0, len(samples), chunk):
+			x = samples[start:start+chunk,np.newaxis]
+			seg = segments(x[:,0])
+			at_samples = index._limits(seg, x)
+			cheaper = np.maximum.accumulate(at_samples, axis=-1)
+			cheaper = np.hstack([np.full((len(x), 1), -np.inf), cheaper[:,:-1]])
+			on_staircase = at_samples > cheaper
+
+			p = on_staircase.sum(axis=-1).max()
+			order = np.argsort(~on_staircase, axis=-1, kind='mergesort')[:,:p]
+			rows.append(np.where(
+				np.take_along_axis(on_staircase, order, axis=-1),
+				np.take_along_axis(seg, order, axis=-1),
+				padding
+			))
+
+		p = max(r.shape[-1] for r in rows)
+		steps = np.concatenate([
+			np.pad(r, [(0, 0), (0, p + 1 - r.shape[-1])], mode='constant', constant_values=padding)
+			for r in rows
+		]).astype(np.int32)
+
+		# drop the crossings which turned out not to change the staircase
+		redundant = ~np.in1d(breaks, xs) & (steps[0:-2:2] == steps[2::2]).all(axis=-1)
+		keep = np.ones(len(samples), dtype=bool)
+		keep[1::2] = keep[2::2] = ~redundant
+
+		index.breaks = breaks[~redundant]
+		index.steps = steps[keep]
+		return index
+
+	def lookup(self, lengths, forces):
+		"""
+		Find the index of the cheapest section able to carry each force over
+		each length, or -1 where no section is strong enough
+		"""
+		lengths, forces = np.broadcast_arrays(np.asarray(lengths, dtype=float), np.asarray(forces, dtype=float))
+		n = len(self.breaks)
+		k = self.steps.shape[-1] - 1
+
+		j = np.searchsorted(self.breaks, lengths)
+		row = 2 * j + (self.breaks[np.minimum(j, n - 1)] == lengths)
+
+		lo = np.zeros(lengths.shape, dtype=int)
+		hi = np.full(lengths.shape, k)
+		while True:
+			searching = lo < hi
+			if not searching.any():
+				break
+			mid = (lo + hi) // 2
+			limit = self._limits(self.steps[row, mid], lengths)
+			below = limit <= forces
+			lo = np.where(searching & below, mid + 1, lo)
+			hi = np.where(searching & ~below, mid, hi)
+
+		return self.owners[self.steps[row, lo]]
+
+
+
+class Catalogue(object):
+	"""
+	A set of sections and their buckling envelopes, compiled into arrays along
+	with the SectionIndex of their cheapest sections.
+
+	Catalogues built by `build` or `load` are cached in `cache_dir`, under a
+	hash of the beams and the modes, as a directory of .npy files which later
+	builds memory-map rather than recompiling.
+
+	Every tension member uses the cheapest section, `tension_section`, which
+	can carry up to `tension_capacity` - the greatest force of its envelope.
+	"""
+	cache_version = 2
+	default_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__sectioncache__')
+
+	def __init__(self, names, costs, envelopes, index=None):
+		self.names = list(names)
+		self.costs = np.asarray(costs)
+		self.envelopes = envelopes
+		if index is None:
+			index = SectionIndex.build(self.costs, self.envelopes)
+		self.index = index
+
+		cheapest = int(np.argmin(self.costs))
+		self.tension_section = self.names[cheapest]
+		self.tension_cost = float(self.costs[cheapest])
+		self.tension_capacity = float(np.max(self.envelopes[cheapest][1]))
+
+	@classmethod
+	def compile(cls, beams, modes=modes):
+		"""
+		Compile every combination of beam and mode. Where sections are equally
+		cheap, lookups choose the first, in the order modes then beams are
+		iterated - as the brute-force search did.
+		"""
+		names, costs, envelopes = [], [], []
+		for mname, mode in modes.items():
 			l_over_bs, stresses = zip(*mode)
+			for bname, beam in beams.items():
+				forces = np.array(stresses) * beam.area
+				lengths = np.array(l_over_bs) * beam.b
+				cost = beam.linear_density * 500
+
+				if mname in ('B', 'C'):
+					forces *= 2
+					cost *= 2
+
+				names.append(bname + mname)
+				costs.append(cost)
+				envelopes.append(_compile_envelope(lengths, forces))
 
-			forces = np.array(stresses) * beam.area
-			lengths = np.array(l_over_bs) * beam.b
+		return cls(names, np.array(costs), envelopes)
+
+	@classmethod
+	def build(cls, beams, modes=modes, cache_dir=default_cache_dir):
+		"""
+		Like `compile`, but reusing the result of an earlier build of the same
+		beams and modes from `cache_dir`, if it is not None
+		"""
+		if cache_dir is None:
+			return cls.compile(beams, modes)
+
+		key = hashlib.sha1()
+		key.update(str(cls.cache_version).encode('ascii'))
+		key.update(json.dumps(modes, sort_keys=True).encode('ascii'))
+		key.update(json.dumps(sorted(
+			(str(name), float(beam.b), float(beam.t), float(beam.area), float(beam.linear_density))
+			for name, beam in beams.items()
+		)).encode('ascii'))
+		cached = os.path.join(cache_dir, key.hexdigest())
+		if os.path.isdir(cached):
+			return cls._load_arrays(cached)
+
+		catalogue = cls.compile(beams, modes)
+		try:
+			catalogue._save_arrays(cached)
+		except (IOError, OSError):
+			# the cache only saves time, so a read-only install still works
+			pass
+		return catalogue
+
+	@classmethod
+	def load(cls, path, modes=modes, cache_dir=default_cache_dir):
+		"""
+		Load a catalogue of beams from a CSV or JSON file, with the fields of
+		BeamCrossSection other than color. JSON files hold either a list of
+		beams with names, or an object mapping names to beams.
+		"""
+		with open(path, 'rb') as f:
+			source = f.read()
+
+		return cls.build(_read_beams(path, source.decode('utf-8')), modes, cache_dir)
+
+	def _arrays(self):
+		# the index holds all the envelopes end to end
+		return dict(
+			names=np.array(self.names, dtype=np.unicode_),
+			costs=self.costs,
+			breaks=self.index.breaks,
+			steps=self.index.steps,
+			xs=self.index.xs,
+			ys=self.index.ys,
+			slopes=self.index.slopes,
+			owners=self.index.owners
+		)
 
-			cost = beam.linear_density
+	def _save_arrays(self, path):
+		# written to a temporary directory and renamed, so that other processes
+		# never see a partial cache
+		parent = os.path.dirname(path)
+		if not os.path.isdir(parent):
+			os.makedirs(parent)
+		tmp = tempfile.mkdtemp(dir=parent)
+		try:
+			for name, a in self._arrays().items():
+				np.save(os.path.join(tmp, name + '.npy'), a)
+			try:
+				os.rename(tmp, path)
+			except OSError:
+				# another process got there first
+				if not os.path.isdir(path):
+					raise
+		finally:
+			if os.path.isdir(tmp):
+				shutil.rmtree(tmp)
 
-			if mname in ('B', 'C'):
-				forces *= 2
-				cost *= 2
+	@classmethod
+	def _load_arrays(cls, path):
+		a = dict(
+			(name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+			for name in ('names', 'costs', 'breaks', 'steps', 'xs', 'ys', 'slopes', 'owners')
+		)
+		index = SectionIndex(a['breaks'], a['steps'], a['xs'], a['ys'], a['slopes'], a['owners'])
+		offsets = np.searchsorted(index.owners[:-2], np.arange(len(a['names']) + 1))
+		return cls(
+			[str(n) for n in a['names']],
+			a['costs'],
+			[
+				(index.xs[i:j], index.ys[i:j], index.slopes[i:j-1])
+				for i, j in zip(offsets[:-1], offsets[1:])
+			],
+			index
+		)
+
+	def best_sections(self, lengths, forces):
+		"""
+		Find the cheapest section able to carry each compressive force over each
+		length, for arrays of lengths and forces. Returns an object array of
+		section names, with None where no section is strong enough, and an array
+		of their costs per unit length, with inf where no section is strong enough.
+		"""
+		best = self.index.lookup(lengths, forces)
+		names = np.array(self.names + [None], dtype=object)[best]
+		costs = np.append(self.costs, np.inf)[best]
+		return names, costs
+
+	def cost_per_force(self, lengths):
+		"""
+		The least cost per unit length per unit of compressive force of any
+		section at each length, as if each could be scaled to carry exactly the
+		force needed. This is inf where no section can be that long.
+		"""
+		lengths = np.asarray(lengths, dtype=float)
+		best = np.full(lengths.shape, np.inf)
+		for cost, envelope in zip(self.costs, self.envelopes):
+			limits = _limits(envelope, lengths)
+			with np.errstate(divide='ignore'):
+				best = np.minimum(best, np.where(limits > 0, cost / limits, np.inf))
+		return best
+
+
+def _read_beams(path, source):
+	ext = os.path.splitext(path)[1].lower()
+	if ext == '.json':
+		rows = json.loads(source)
+		if isinstance(rows, dict):
+			rows = [dict(row, name=name) for name, row in rows.items()]
+	elif ext == '.csv':
+		rows = csv.DictReader(source.splitlines())
+	else:
+		raise ValueError("Unknown catalogue format {!r}".format(ext))
+
+	return dict(
+		(str(row['name']), BeamCrossSection(
+			b=float(row['b']),
+			t=float(row['t']),
+			area=float(row['area']),
+			linear_density=float(row['linear_density']),
+			color=None
+		))
+		for row in rows
+	)
+
+
+catalogue = Catalogue.build(beams, modes)
+section_names = catalogue.names
+section_costs = catalogue.costs
+section_index = catalogue.index
+_envelopes = catalogue.envelopes
+
+def is_below(xs, ys, x, y):
+	return bool(y < _limits(_compile_envelope(xs, ys), x))
+
+def valid_sections(length, force):
+	for name, cost, envelope in zip(section_names, section_costs, _envelopes):
+		if force < _limits(envelope, length):
+			yield name, cost
 
-			if is_below(lengths, forces, length, force):
-				yield bname + mname, cost * 500
+best_sections = catalogue.best_sections
 
 def best_section(length, force):
-	try:
-		return min(valid_sections(length, force), key=lambda x: x[1])
-	except:
+	names, costs = best_sections([length], [force])
+	if names[0] is None:
 		raise ValueError("No beam of length {} can take force {}".format(length, force))
+	return names[0], costs[0]
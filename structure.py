@@ -1,14 +1,48 @@
 import numpy as np
+import re
+from bisect import bisect_left
 from collections import deque
+from fnmatch import fnmatchcase
+from itertools import count, islice, takewhile
+
+try:
+	import scipy.sparse
+	import scipy.sparse.linalg
+except ImportError:
+	scipy = None
+
+
+# stamps for joint positions, which increase every time any joint moves
+_versions = count(1)
 
 
 class Joint(object):
-	"""A pin joint"""
+	"""
+	A pin joint
+
+	`pos` is read-only - move a joint by assigning a new position, which
+	updates `version` so that cached geometry can be invalidated.
+	"""
 	def __init__(self, name, pos):
 		self.name = name
-		self.pos = np.asarray(pos)
+		self.pos = pos
 		self.beams = set()
 
+	@property
+	def pos(self):
+		return self._pos
+
+	@pos.setter
+	def pos(self, pos):
+		self._pos = np.array(pos)
+		self._pos.flags.writeable = False
+		self.version = next(_versions)
+
+	def __setstate__(self, state):
+		# versions are only unique within one process, so take a new one
+		self.__dict__.update(state)
+		self.pos = state['_pos']
+
 	def __repr__(self):
 		return "{s.__class__.__name__}({s.name!r}, {s.pos!r})".format(s=self)
 
@@ -25,17 +59,34 @@ class Beam(object):
 		self.a.beams.add(self)
 		self.b.beams.add(self)
 
+		self._geometry = None
+
 	def __repr__(self):
 		return "<Beam {s.a.name}-{s.b.name}>".format(s=self)
 
+	def __getstate__(self):
+		return dict(self.__dict__, _geometry=None)
+
+	def _cached_geometry(self):
+		"""The length and direction, recomputed only if either joint has moved"""
+		key = (self.a.version, self.b.version)
+		if self._geometry is None or self._geometry[0] != key:
+			diff = self.b.pos - self.a.pos
+			length = np.linalg.norm(diff)
+			direction = diff / length
+			direction.flags.writeable = False
+			self._geometry = key, length, direction
+
+		return self._geometry[1:]
+
 	@property
 	def length(self):
-		return np.linalg.norm(self.b.pos - self.a.pos)
+		return self._cached_geometry()[0]
 
 	@property
 	def direction(self):
 		"""The unit vector pointing from a to b"""
-		return (self.b.pos - self.a.pos) / self.length
+		return self._cached_geometry()[1]
 
 
 class Truss(object):
@@ -45,72 +96,1330 @@ class Truss(object):
 		self.joints = set()
 
 		self.dimensions = None
+		self.mirror = None
+		self._compiled = None
+		self._elimination_plan = None
+		self._maxwell = None
+		self._mirror_halves = None
+
+		# indices for lookup by name
+		self._joints_by_name = {}
+		self._beams_by_names = {}
+		self._sorted_names = None
 
 		self._walk(component)
 
+	def __getstate__(self):
+		# the caches are keyed by joint versions, which do not survive pickling
+		return dict(self.__dict__, _compiled=None, _mirror_halves=None)
+
+	def __repr__(self):
+		return "<Truss: {} joints, {} beams>".format(len(self.joints), len(self.beams))
+
+	@classmethod
+	def components(cls, items):
+		"""
+		Find every distinct structure that the given joints and beams belong
+		to, returning a list of `Truss` objects. Each structure is only walked
+		once, however many of the items belong to it.
+		"""
+		trusses = []
+		seen = set()
+		for item in items:
+			joint = item.a if isinstance(item, Beam) else item
+			if joint in seen:
+				continue
+
+			st = cls(item)
+			seen.update(st.joints)
+			trusses.append(st)
+
+		return trusses
+
+	def add(self, component):
+		"""
+		Add a beam or joint created after this truss, along with anything
+		newly connected to it
+		"""
+		if component in self.joints:
+			# an existing joint - look for new beams attached to it
+			for beam in list(component.beams):
+				if beam not in self.beams:
+					self._walk(beam)
+		else:
+			self._walk(component)
+		self._compiled = None
+		self._elimination_plan = None
+		self._maxwell = None
+		self._mirror_halves = None
+
+	def _add_beam(self, beam):
+		key = frozenset([beam.a.name, beam.b.name])
+		if key in self._beams_by_names:
+			raise ValueError("Duplicate beam between {!r} and {!r}".format(beam.a.name, beam.b.name))
+
+		self.beams.add(beam)
+		self._beams_by_names[key] = beam
+
+	def _add_joint(self, joint):
+		if joint.name in self._joints_by_name:
+			raise ValueError("Duplicate joint name {!r}".format(joint.name))
+
+		if self.dimensions is None:
+			self.dimensions = len(joint.pos)
+		elif self.dimensions != len(joint.pos):
+			raise ValueError("Dimensions are not consistent!")
+
+		self.joints.add(joint)
+		self._joints_by_name[joint.name] = joint
+		self._sorted_names = None
+
 	def _walk(self, component):
 		"""Find all connected components"""
 
 		if isinstance(component, Beam):
 			if component not in self.beams:
-				self.beams.add(component)
-				self._walk(component.a)
-				self._walk(component.b)
-
+				self._add_beam(component)
+			to_visit = [component.a, component.b]
 		elif isinstance(component, Joint):
-			if component not in self.joints:
-				if self.dimensions is None:
-					self.dimensions = len(component.pos)
-				elif self.dimensions != len(component.pos):
-					raise ValueError("Dimensions are not consistent!")
-
-				self.joints.add(component)
-				for beam in component.beams:
-					self._walk(beam)
-
+			to_visit = [component]
 		else:
 			raise ValueError("Unexpected component {!r}".format(component))
 
+		# depth-first, with an explicit stack so that long chains of beams
+		# don't hit the recursion limit
+		while to_visit:
+			joint = to_visit.pop()
+			if joint in self.joints:
+				continue
+
+			self._add_joint(joint)
+			for beam in joint.beams:
+				if beam not in self.beams:
+					self._add_beam(beam)
+					to_visit.append(beam.b if beam.a is joint else beam.a)
+
 
 	def __getitem__(self, x):
-		"""Access components by name"""
+		"""
+		Access components by name. A pair of names gives the beam between
+		them, and a slice of names gives a list of the joints with names in
+		that range.
+		"""
 		if isinstance(x, tuple):
-			x = set(x)
-			return next(b for b in self.beams if set([b.a.name, b.b.name]) == x)
+			return self._beams_by_names[frozenset(x)]
+		elif isinstance(x, slice):
+			if x.step is not None:
+				raise ValueError("Cannot slice joints with a step")
+			names = self._names()
+			start = 0 if x.start is None else bisect_left(names, x.start)
+			stop = len(names) if x.stop is None else bisect_left(names, x.stop)
+			return [self._joints_by_name[n] for n in names[start:stop]]
+		else:
+			return self._joints_by_name[x]
+
+	def _names(self):
+		"""All the joint names, in sorted order"""
+		if self._sorted_names is None:
+			self._sorted_names = sorted(self._joints_by_name)
+		return self._sorted_names
+
+	def find(self, pattern):
+		"""Find all the joints with names matching a glob-style pattern, like "C*" """
+		names = self._names()
+
+		# only names starting with the literal part of the pattern can match
+		prefix = re.match(r'[^*?[]*', pattern).group()
+		candidates = takewhile(
+			lambda n: n.startswith(prefix),
+			islice(names, bisect_left(names, prefix), None)
+		)
+		return [self._joints_by_name[n] for n in candidates if fnmatchcase(n, pattern)]
+
+	def set_mirror(self, normal, origin=0, images='name', tol=1e-6):
+		"""
+		Declare that the structure is symmetric about the plane through `origin`
+		with normal `normal`, so that symmetric loads are solved on half of it.
+
+		Joints are paired with their mirror images by name with images='name',
+		where the image of "X" is "X'", or by position with images='position'.
+		Alternatively, pass a `{joint: image}` dict. Joints without an image are
+		their own, and must lie on the plane.
+		"""
+		if images == 'name':
+			pairs = {}
+			for name, joint in self._joints_by_name.items():
+				image = name[:-1] if name.endswith("'") else name + "'"
+				pairs[joint] = self._joints_by_name.get(image, joint)
+		elif images == 'position':
+			mirror = Mirror(normal, origin, {}, tol)
+			key = lambda pos: tuple(np.round(pos / tol).astype(np.int64))
+			by_position = dict((key(j.pos), j) for j in self.joints)
+			pairs = dict(
+				(j, by_position.get(key(mirror.reflect(j.pos)), j)) for j in self.joints
+			)
 		else:
-			return next(j for j in self.joints if j.name == x)
+			pairs = dict((j, images.get(j, j)) for j in self.joints)
+			pairs.update((image, j) for j, image in images.items())
+
+		mirror = Mirror(normal, origin, pairs, tol)
+		if any(pairs[image] is not j for j, image in pairs.items()):
+			raise ValueError("Joints must be paired with each other")
+		images = mirror.image_indices(self.compile())
+		if images is None:
+			raise ValueError("Not every beam has a mirror image")
+		if not mirror.is_symmetric(self.compile(), images[0]):
+			raise ValueError("The structure is not symmetric about this plane")
+		self.mirror = mirror
+
+	@property
+	def geometry_version(self):
+		"""A number which increases whenever any joint in the structure moves"""
+		return max(j.version for j in self.joints)
+
+	def compile(self):
+		"""
+		Build a `CompiledTruss` holding the current geometry of this structure
+
+		Joints and beams are indexed in the order of the `joints` and `beams`
+		attributes of the result, which hold the objects from this truss. The
+		result is cached until a joint moves, or a component is added.
+		"""
+		version = self.geometry_version
+		if self._compiled is None or self._compiled[0] != version:
+			self._compiled = version, self._compile()
+		return self._compiled[1]
+
+	def _compile(self):
+		joints = list(self.joints)
+		beams = list(self.beams)
+		index = dict((j, i) for i, j in enumerate(joints))
+
+		return CompiledTruss(
+			positions=np.array([j.pos for j in joints], dtype=float).reshape(-1, self.dimensions),
+			connectivity=np.array([(index[b.a], index[b.b]) for b in beams], dtype=int).reshape(-1, 2),
+			mounts=np.array([isinstance(j, Mount) for j in joints], dtype=bool),
+			names=[j.name for j in joints],
+			joints=joints,
+			beams=beams
+		)
+
+	@staticmethod
+	def from_arrays(positions, connectivity, mounts=None, names=None):
+		"""
+		Build a `CompiledTruss` directly from arrays, without creating any
+		`Joint` or `Beam` objects. See `CompiledTruss` for the arguments.
+		"""
+		return CompiledTruss(positions, connectivity, mounts, names)
+
+	def equilibrium_matrix(self):
+		"""
+		Build the matrix relating member forces to the forces at each joint
+
+		Rows are the degrees of freedom of each joint, and columns are the
+		tension in each beam, followed by the reaction components at each
+		mount. Returns the matrix, and the joints and beams in the order used.
+		"""
+		return self.compile().equilibrium_matrix()
+
+	def analyze_determinacy(self):
+		"""
+		Check whether the structure can be solved by pin-jointed analysis,
+		without attempting to solve it. Returns a `Determinacy`.
+
+		The result is cached until the geometry of the structure changes.
+		"""
+		return self.compile().analyze_determinacy()
+
+	@property
+	def maxwell(self):
+		"""
+		The number of unknowns less the number of equilibrium equations, by
+		Maxwell's rule. Positive means redundant members, and negative means
+		mechanisms - either way, the structure is not determinate.
+
+		This only depends on the topology, so it is cached until `add` is
+		called, and moving joints does not invalidate it.
+		"""
+		if self._maxwell is None:
+			n_mounts = sum(1 for j in self.joints if isinstance(j, Mount))
+			self._maxwell = len(self.beams) + self.dimensions * (n_mounts - len(self.joints))
+		return self._maxwell
+
+
+class CompiledTruss(object):
+	"""
+	An array-backed, read-only form of a truss
+
+	`positions` is an `(n_joints, dim)` array of joint positions,
+	`connectivity` an `(n_beams, 2)` array of the joint indices at the ends of
+	each beam, and `mounts` a boolean mask of which joints are mounts. Joints
+	default to being named by their index.
+
+	Build one with `Truss.compile` or `Truss.from_arrays`. Anything that
+	accepts a `Truss` for analysis also accepts one of these - results are
+	keyed by the entries of `joints` and `beams`, which are the original
+	objects if compiled from a `Truss`, and names or name pairs otherwise.
+	"""
+	def __init__(self, positions, connectivity, mounts=None, names=None, joints=None, beams=None):
+		self.positions = np.array(positions, dtype=float)
+		if self.positions.ndim != 2:
+			raise ValueError("positions must be an (n_joints, dim) array")
+		n_joints, self.dimensions = self.positions.shape
+
+		self.connectivity = np.array(connectivity, dtype=int).reshape(-1, 2)
+		if self.connectivity.size and (self.connectivity.min() < 0 or self.connectivity.max() >= n_joints):
+			raise ValueError("connectivity refers to joints which do not exist")
+
+		if mounts is None:
+			self.mounts = np.zeros(n_joints, dtype=bool)
+		else:
+			self.mounts = np.array(mounts, dtype=bool).reshape(n_joints)
+
+		for arr in (self.positions, self.connectivity, self.mounts):
+			arr.flags.writeable = False
+
+		self._names = list(names) if names is not None else None
+		self._joints = joints
+		self._beams = beams
+		self._joint_index = None
+		self._beam_index = None
+		self._key_index = None
+		self._determinacy = None
+
+		# all the geometry, at once
+		diff = self.positions[self.connectivity[:,1]] - self.positions[self.connectivity[:,0]]
+		self.lengths = np.linalg.norm(diff, axis=1)
+		self.directions = diff / self.lengths[:,np.newaxis]
+		self.lengths.flags.writeable = False
+		self.directions.flags.writeable = False
+
+	def __repr__(self):
+		return "<CompiledTruss: {} joints, {} beams>".format(len(self.positions), len(self.connectivity))
+
+	@property
+	def names(self):
+		if self._names is None:
+			self._names = [str(i) for i in range(len(self.positions))]
+		return self._names
+
+	@property
+	def joints(self):
+		"""The key used for each joint"""
+		if self._joints is None:
+			self._joints = self.names
+		return self._joints
+
+	@property
+	def beams(self):
+		"""The key used for each beam"""
+		if self._beams is None:
+			names = self.names
+			self._beams = [(names[a], names[b]) for a, b in self.connectivity]
+		return self._beams
+
+	@property
+	def joint_index(self):
+		"""A mapping from joint name to index"""
+		if self._joint_index is None:
+			self._joint_index = dict((n, i) for i, n in enumerate(self.names))
+		return self._joint_index
+
+	@property
+	def beam_index(self):
+		"""A mapping from `frozenset([name_a, name_b])` to beam index"""
+		if self._beam_index is None:
+			names = self.names
+			self._beam_index = dict(
+				(frozenset([names[a], names[b]]), i) for i, (a, b) in enumerate(self.connectivity)
+			)
+		return self._beam_index
+
+	def index(self, joint):
+		"""Find the index of a joint, given either its key or its name"""
+		if self._key_index is None:
+			self._key_index = dict((j, i) for i, j in enumerate(self.joints))
+		try:
+			return self._key_index[joint]
+		except KeyError:
+			return self.joint_index[joint]
+
+	def forces_array(self, forces):
+		"""
+		Convert a `{joint: force}` dict, or a list of them, into an array of
+		shape `(n_joints, dim)` or `(n_cases, n_joints, dim)`
+		"""
+		if isinstance(forces, dict):
+			return self.forces_array([forces])[0]
+
+		f = np.zeros((len(forces), len(self.positions), self.dimensions))
+		for i, case in enumerate(forces):
+			for joint, force in case.items():
+				f[i, self.index(joint)] = force
+		return f
+
+	def equilibrium_matrix(self):
+		"""
+		Build the matrix relating member forces to the forces at each joint
+
+		Rows are the degrees of freedom of each joint, and columns are the
+		tension in each beam, followed by the reaction components at each
+		mount. Returns the matrix, and the joint and beam keys in order.
+		"""
+		dim = self.dimensions
+		n_joints = len(self.positions)
+		n_beams = len(self.connectivity)
+		a_idx, b_idx = self.connectivity.T
+		dirs = self.directions
+
+		a_dofs = a_idx[:,np.newaxis] * dim + np.arange(dim)
+		b_dofs = b_idx[:,np.newaxis] * dim + np.arange(dim)
+		beam_cols = np.repeat(np.arange(n_beams), dim)
+
+		mount_dofs = np.flatnonzero(self.mounts)[:,np.newaxis] * dim + np.arange(dim)
+		mount_cols = n_beams + np.arange(mount_dofs.size)
+
+		matrix = _sparse_matrix(
+			np.concatenate([dirs.ravel(), -dirs.ravel(), np.ones(len(mount_cols))]),
+			np.concatenate([a_dofs.ravel(), b_dofs.ravel(), mount_dofs.ravel()]),
+			np.concatenate([beam_cols, beam_cols, mount_cols]),
+			shape=(n_joints * dim, n_beams + len(mount_cols))
+		)
+
+		return matrix, self.joints, self.beams
+
+	def equilibrium_derivative(self, tensions):
+		"""
+		Build the derivative of the joint forces `equilibrium_matrix() . x`
+		with respect to every joint coordinate, for fixed beam tensions - an
+		`(n_joints * dim, n_joints * dim)` matrix.
+		"""
+		dim = self.dimensions
+		a_idx, b_idx = self.connectivity.T
+		a_dofs = a_idx[:,np.newaxis] * dim + np.arange(dim)
+		b_dofs = b_idx[:,np.newaxis] * dim + np.arange(dim)
+
+		# moving end b turns the direction by (I - d d^T) / L
+		d = self.directions
+		turn = np.eye(dim) - d[:,:,np.newaxis] * d[:,np.newaxis,:]
+		blocks = turn * (np.asarray(tensions, dtype=float) / self.lengths)[:,np.newaxis,np.newaxis]
+
+		rows, cols, values = [], [], []
+		for r, c, sign in [(a_dofs, b_dofs, 1), (b_dofs, b_dofs, -1), (a_dofs, a_dofs, -1), (b_dofs, a_dofs, 1)]:
+			rows.append(np.broadcast_to(r[:,:,np.newaxis], blocks.shape).ravel())
+			cols.append(np.broadcast_to(c[:,np.newaxis,:], blocks.shape).ravel())
+			values.append(sign * blocks.ravel())
+
+		n_dofs = len(self.positions) * dim
+		return _sparse_matrix(
+			np.concatenate(values), np.concatenate(rows), np.concatenate(cols), shape=(n_dofs, n_dofs)
+		)
+
+	def analyze_determinacy(self):
+		"""
+		Check whether the structure can be solved by pin-jointed analysis,
+		without attempting to solve it. Returns a `Determinacy`.
+		"""
+		if self._determinacy is None:
+			self._determinacy = Determinacy(*self.equilibrium_matrix(), dimensions=self.dimensions)
+		return self._determinacy
+
+
+class Mirror(object):
+	"""
+	A plane of mirror symmetry of a truss, through `origin` with normal `normal`
+
+	`images` maps every joint to its mirror image, with joints on the plane
+	being their own images. Beams are mapped to the beam between the images of
+	their ends.
+	"""
+	def __init__(self, normal, origin, images, tol=1e-6):
+		normal = np.asarray(normal, dtype=float)
+		self.normal = normal / np.linalg.norm(normal)
+		self.origin = np.zeros_like(normal) + origin
+		self.images = images
+		self.tol = tol
+		self.reflection = np.eye(len(normal)) - 2 * np.outer(self.normal, self.normal)
+
+	def __repr__(self):
+		return "<Mirror: normal {}, through {}>".format(self.normal, self.origin)
+
+	def reflect(self, positions):
+		positions = np.asarray(positions, dtype=float)
+		return positions - 2 * np.dot(positions - self.origin, self.normal)[...,np.newaxis] * self.normal
+
+	def image_indices(self, compiled):
+		"""
+		The index of the image of each joint and each beam of a compiled
+		structure, or None if some beam has no image
+		"""
+		joint_images = np.array([compiled.index(self.images.get(j, j)) for j in compiled.joints], dtype=int)
+
+		# find the beams between the images of the ends of each beam, by
+		# looking up their ends as single sorted keys
+		n = len(joint_images)
+		ends = np.sort(compiled.connectivity, axis=1)
+		keys = ends[:,0] * n + ends[:,1]
+		image_ends = np.sort(joint_images[compiled.connectivity], axis=1)
+		image_keys = image_ends[:,0] * n + image_ends[:,1]
+
+		order = np.argsort(keys)
+		found = np.searchsorted(keys, image_keys, sorter=order)
+		found = order[np.minimum(found, len(keys) - 1)] if len(keys) else found
+		if not np.array_equal(keys[found], image_keys):
+			return None
+		beam_images = found
+		return joint_images, beam_images
+
+	def is_symmetric(self, compiled, joint_images):
+		"""Whether the joints and mounts are still in symmetric positions"""
+		scale = max(np.abs(compiled.positions).max(), 1)
+		return (
+			np.array_equal(compiled.mounts[joint_images], compiled.mounts) and
+			np.allclose(self.reflect(compiled.positions), compiled.positions[joint_images], rtol=0, atol=self.tol * scale)
+		)
+
+	def bases(self, compiled, joint_images, beam_images):
+		"""
+		Orthonormal bases for the symmetric and then the antisymmetric parts of
+		the joint forces, and of the tensions and reactions, as the columns of
+		pairs of matrices. The equilibrium matrix maps each part onto itself.
+		"""
+		dim = compiled.dimensions
+		n_beams = len(beam_images)
+		mounts = np.flatnonzero(compiled.mounts)
+		mount_images = np.searchsorted(mounts, joint_images[mounts])
+
+		bases = []
+		for sign in (1, -1):
+			values, rows, cols, n_dofs = _mirror_basis(joint_images, self.reflection, sign)
+			forces = _sparse_matrix(values, rows, cols, shape=(len(joint_images) * dim, n_dofs))
+
+			b_values, b_rows, b_cols, n_b = _mirror_basis(beam_images, np.eye(1), sign)
+			r_values, r_rows, r_cols, n_r = _mirror_basis(mount_images, self.reflection, sign)
+			unknowns = _sparse_matrix(
+				np.concatenate([b_values, r_values]),
+				np.concatenate([b_rows, n_beams + r_rows]),
+				np.concatenate([b_cols, n_b + r_cols]),
+				shape=(n_beams + len(mounts) * dim, n_b + n_r)
+			)
+			bases.append((forces, unknowns))
+		return bases
+
+
+class _MirrorHalves(object):
+	"""
+	The equilibrium equations of a truss with a mirror plane, split into their
+	symmetric and antisymmetric halves.
+
+	The bases of each half only depend on which joints and beams are images of
+	each other, so are kept as joints move. The factorization of each half is
+	made the first time a load needs it, and kept until the geometry changes,
+	which is when `compile` builds a new `CompiledTruss`.
+	"""
+	def __init__(self, mirror, compiled):
+		self.mirror = mirror
+		self.images = mirror.image_indices(compiled)
+		self.bases = None
+		if self.images is not None:
+			self.bases = mirror.bases(compiled, *self.images)
+
+		self._compiled = None
+		self._symmetric = False
+		self._factorizations = None
+
+	def is_symmetric(self, compiled):
+		"""Whether the halves apply to the current geometry"""
+		if compiled is not self._compiled:
+			self._compiled = compiled
+			self._factorizations = [None, None]
+			self._symmetric = self.images is not None and self.mirror.is_symmetric(compiled, self.images[0])
+		return self._symmetric
+
+	def factorization(self, i):
+		"""The factorization of the symmetric (0) or antisymmetric (1) half"""
+		if self._factorizations[i] is None:
+			dofs, unknowns = self.bases[i]
+			matrix = self._compiled.equilibrium_matrix()[0]
+			self._factorizations[i] = _Factorization(dofs.T.dot(matrix).dot(unknowns))
+		return self._factorizations[i]
+
+
+def _mirror_basis(images, reflection, sign):
+	"""
+	An orthonormal basis for the vectors of items with len(reflection)
+	components each, which the mirror maps to `sign` times themselves. Returns
+	the values, rows and columns of its entries, and the number of columns.
+	"""
+	d = len(reflection)
+	items = np.arange(len(images))
+	pairs = items[images > items]
+	singles = items[images == items]
+
+	# a vector for each component of each pair, split between its two items
+	pair_cols = np.arange(len(pairs) * d).reshape(len(pairs), d)
+	a_rows = pairs[:,np.newaxis] * d + np.arange(d)
+	b_rows = images[pairs][:,np.newaxis,np.newaxis] * d + np.arange(d)[:,np.newaxis]
+	b_values = sign * reflection / np.sqrt(2)
+
+	# and for items which are their own image, the components which the
+	# reflection maps to sign times themselves
+	w, v = np.linalg.eigh(reflection)
+	u = v[:,np.isclose(w, sign)]
+	single_cols = pair_cols.size + np.arange(len(singles) * u.shape[1]).reshape(len(singles), u.shape[1])
+	s_rows = singles[:,np.newaxis,np.newaxis] * d + np.arange(d)[:,np.newaxis]
+
+	shape_b = (len(pairs), d, d)
+	shape_s = (len(singles), d, u.shape[1])
+	return (
+		np.concatenate([
+			np.full(a_rows.size, 1 / np.sqrt(2)),
+			np.broadcast_to(b_values, shape_b).ravel(),
+			np.broadcast_to(u, shape_s).ravel()
+		]),
+		np.concatenate([
+			a_rows.ravel(),
+			np.broadcast_to(b_rows, shape_b).ravel(),
+			np.broadcast_to(s_rows, shape_s).ravel()
+		]),
+		np.concatenate([
+			pair_cols.ravel(),
+			np.broadcast_to(pair_cols[:,np.newaxis,:], shape_b).ravel(),
+			np.broadcast_to(single_cols[:,np.newaxis,:], shape_s).ravel()
+		]),
+		pair_cols.size + single_cols.size
+	)
+
+
+class Determinacy(object):
+	"""
+	The result of checking a structure for static determinacy
+
+	Maxwell's rule compares the number of unknowns (beam tensions and reaction
+	components) against the number of equilibrium equations (joint degrees of
+	freedom). The rank of the equilibrium matrix then determines how many
+	independent mechanisms and states of self-stress there really are.
+
+	`mechanisms` is a list of `{joint: displacement}` dicts, each describing a
+	way the structure can move without any beam changing length. `self_stresses`
+	is a list of `{beam: tension}` dicts, each describing a set of tensions
+	which are in equilibrium with no load. Any beam in one of these is
+	redundant, and listed in `redundant_beams`.
+
+	Only `is_determinate` is found up front, from the pivots of a sparse LU
+	factorization. The rest need a dense SVD, so are found the first time
+	they are used; printing a `Determinacy` never needs one.
+	"""
+	def __init__(self, matrix, joints, beams, dimensions):
+		self.equations, self.unknowns = matrix.shape
+		self.maxwell = self.unknowns - self.equations
+
+		self._matrix = matrix
+		self._joints = joints
+		self._beams = beams
+		self._dimensions = dimensions
+		self._is_determinate = None
+		self._svd = None
+		self._mechanisms = None
+		self._self_stresses = None
+
+	@property
+	def is_determinate(self):
+		"""Whether every loading has exactly one solution"""
+		if self._is_determinate is None:
+			self._is_determinate = self.maxwell == 0 and _full_rank(self._matrix)
+		return self._is_determinate
+
+	@property
+	def rank(self):
+		"""The rank of the equilibrium matrix"""
+		if self.is_determinate:
+			return self.unknowns
+		return self._decompose()[0]
+
+	@property
+	def mechanisms(self):
+		if self._mechanisms is None:
+			# left null space - joint movements resisted by nothing
+			self._mechanisms = []
+			if not self.is_determinate:
+				rank, u, vt = self._decompose()
+				for mode in _complement(u, rank).T:
+					mode = mode.reshape(-1, self._dimensions)
+					self._mechanisms.append(dict(
+						(j, d) for j, d in zip(self._joints, mode) if np.linalg.norm(d) > 1e-9
+					))
+		return self._mechanisms
+
+	@property
+	def self_stresses(self):
+		if self._self_stresses is None:
+			# null space - tensions that need no load
+			self._self_stresses = []
+			if not self.is_determinate:
+				rank, u, vt = self._decompose()
+				for state in _complement(vt.T, rank).T:
+					self._self_stresses.append(dict(
+						(b, t) for b, t in zip(self._beams, state) if abs(t) > 1e-9
+					))
+		return self._self_stresses
+
+	@property
+	def redundant_beams(self):
+		return set(b for state in self.self_stresses for b in state)
+
+	def _decompose(self):
+		"""
+		The rank, and the left and right singular vectors, by a dense economy
+		SVD. Only the smaller side gets a full basis - see `_complement`.
+		"""
+		if self._svd is None:
+			matrix = self._matrix
+			if hasattr(matrix, 'toarray'):
+				matrix = matrix.toarray()
+
+			u, s, vt = np.linalg.svd(matrix, full_matrices=False)
+			tol = s.max() * max(matrix.shape) * np.finfo(float).eps if s.size else 0
+			self._svd = int(np.sum(s > tol)), u, vt
+		return self._svd
+
+	def __repr__(self):
+		return "<Determinacy: {} unknowns, {} equations, Maxwell count {}, {}>".format(
+			self.unknowns, self.equations, self.maxwell,
+			'determinate' if self.is_determinate else 'not determinate'
+		)
+
+
+def _complement(basis, rank):
+	"""
+	An orthonormal basis, as columns, for everything orthogonal to the first
+	`rank` columns of the orthonormal `basis`. If `basis` is not square, as on
+	the larger side of an economy SVD, it is completed by QR.
+	"""
+	size = basis.shape[0]
+	if basis.shape[1] == size:
+		return basis[:,rank:]
+	if rank == 0:
+		return np.eye(size)
+	q, r = np.linalg.qr(basis[:,:rank], mode='complete')
+	return q[:,rank:]
 
 
 class NotStaticallyDeterminate(Exception):
 	"""Indicates that the structure cannot be analyzed solely by pin-jointed analysis"""
-	pass
+	def __init__(self, structure=None):
+		super(NotStaticallyDeterminate, self).__init__()
+		self.structure = structure
+
+	@property
+	def determinacy(self):
+		"""The `Determinacy` of the offending structure, if known"""
+		if self.structure is not None:
+			return self.structure.analyze_determinacy()
+
+	def __str__(self):
+		if self.structure is None:
+			return ''
+		return "{!r} cannot be solved by pin-jointed analysis".format(self.structure)
+
+
+def _compiled(st):
+	"""Get the compiled form of a `Truss` or `CompiledTruss`"""
+	if isinstance(st, CompiledTruss):
+		return st
+	return st.compile()
+
+
+def _sparse_matrix(values, rows, cols, shape):
+	"""Build a matrix from coordinates, using scipy.sparse if it is available"""
+	if scipy is not None:
+		return scipy.sparse.coo_matrix((values, (rows, cols)), shape=shape).tocsc()
+
+	matrix = np.zeros(shape)
+	np.add.at(matrix, (rows, cols), values)
+	return matrix
+
+
+class _Factorization(object):
+	"""
+	A factorized equilibrium matrix, which can be solved for many right hand
+	sides.
+
+	Square matrices are factorized directly. Matrices with more rows than
+	columns (mechanisms) are solved in a least-squares sense, and the solution
+	only accepted if it satisfies the equations exactly.
+	"""
+	def __init__(self, matrix):
+		n_rows, n_cols = matrix.shape
+		if n_cols > n_rows:
+			# more unknowns than equations - redundant members
+			raise NotStaticallyDeterminate()
+
+		self.matrix = matrix
+		self._square = n_rows == n_cols
+		normal = matrix if self._square else matrix.T.dot(matrix)
+
+		if scipy is not None:
+			try:
+				lu = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(normal))
+			except RuntimeError:
+				# exactly singular
+				raise NotStaticallyDeterminate()
+			if self._square and not _nonsingular(lu):
+				raise NotStaticallyDeterminate()
+			self._solve = lu.solve
+			self._solve_transpose = lambda b: lu.solve(b, trans='T')
+		else:
+			try:
+				inverse = np.linalg.inv(normal)
+			except np.linalg.LinAlgError:
+				raise NotStaticallyDeterminate()
+			self._solve = inverse.dot
+			self._solve_transpose = inverse.T.dot
+
+	def solve(self, b, check=True):
+		"""
+		Solve `matrix x = b`, where b is a vector or a matrix of columns.
+
+		Unless check is False, solutions which do not satisfy the equations
+		raise NotStaticallyDeterminate.
+		"""
+		b = np.asarray(b, dtype=float)
+		x = self._solve(b if self._square else self.matrix.T.dot(b))
+
+		# reject near-singular solutions, and loads that a mechanism cannot carry.
+		# A least-squares solution is only exact if the load can be carried at
+		# all, so it is held to the size of the load alone.
+		size = _term_size(self.matrix, x) if self._square else 0
+		if check and not _satisfies(self.matrix.dot(x), b, size):
+			raise NotStaticallyDeterminate()
+
+		return x
+
+	def solve_transpose(self, b):
+		"""Solve `matrix.T x = b`, for a square matrix"""
+		assert self._square
+		return self._solve_transpose(np.asarray(b, dtype=float))
+
+
+def _satisfies(lhs, rhs, size=0):
+	"""
+	Check that a solution reproduces the right hand side it was solved for.
+	`size` is the largest term summed into `lhs`, such as a large tension
+	which the load only balances to within rounding.
+	"""
+	scale = max(np.abs(rhs).max() if rhs.size else 0, size, 1)
+	return np.all(np.isfinite(lhs)) and np.allclose(lhs, rhs, atol=1e-8 * scale)
+
+def _term_size(matrix, x):
+	"""The largest term of the product `matrix . x`"""
+	return np.max(abs(matrix).dot(np.abs(x))) if np.size(x) else 0
+
+
+def _full_rank(matrix, tol=1e-10):
+	"""
+	Check whether a square matrix is nonsingular, from the pivots of its LU
+	factorization rather than a dense SVD
+	"""
+	if not matrix.shape[0]:
+		return True
+	if scipy is None:
+		s = np.linalg.svd(matrix, compute_uv=False)
+		return s.min() > tol * s.max()
+
+	try:
+		lu = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(matrix))
+	except RuntimeError:
+		# exactly singular
+		return False
+	return _nonsingular(lu, tol)
+
+def _nonsingular(lu, tol=1e-10):
+	"""Check the pivots of a sparse LU factorization for a near-zero one"""
+	pivots = np.abs(lu.U.diagonal())
+	return pivots.min() > tol * pivots.max()
+
+
+class _LowRankUpdate(object):
+	"""
+	Solutions of an equilibrium matrix after some of its columns have
+	changed, using the factorization of the original matrix and the
+	Sherman-Morrison-Woodbury formula.
+	"""
+	# the number of changed columns beyond which refactorizing is cheaper
+	max_rank = 64
+
+	def __init__(self, factorization, compiled, rhs):
+		self.factorization = factorization
+		self.compiled = compiled
+		self.rhs = rhs
+		self._original = factorization.solve(rhs, check=False)
+		self._columns = dict((b, i) for i, b in enumerate(compiled.beams))
+
+		# {column: (change in column, original matrix solved for that change)}
+		self._changes = {}
+
+	@property
+	def rank(self):
+		return len(self._changes)
+
+	def move(self, joint):
+		"""Account for the beams at a joint having moved, and solve again"""
+		matrix = self.factorization.matrix
+		dim = self.compiled.dimensions
+		index = self.compiled.index
+
+		for beam in joint.beams:
+			col = self._columns.get(beam)
+			if col is None:
+				continue
+
+			column = np.zeros(matrix.shape[0])
+			a = index(beam.a) * dim
+			b = index(beam.b) * dim
+			column[a:a+dim] = beam.direction
+			column[b:b+dim] = -beam.direction
+
+			original = matrix[:,col]
+			if hasattr(original, 'toarray'):
+				original = original.toarray()
+			delta = column - np.ravel(original)
+			self._changes[col] = delta, self.factorization.solve(delta, check=False)
+
+		cols = sorted(self._changes)
+		u = np.column_stack([self._changes[c][0] for c in cols])
+		z = np.column_stack([self._changes[c][1] for c in cols])
+
+		# (A + U E^T)^-1 b = y - Z (I + E^T Z)^-1 E^T y
+		y = self._original
+		try:
+			x = y - z.dot(np.linalg.solve(np.eye(len(cols)) + z[cols], y[cols]))
+		except np.linalg.LinAlgError:
+			raise NotStaticallyDeterminate()
+
+		if not _satisfies(matrix.dot(x) + u.dot(x[cols]), self.rhs, _term_size(matrix, x)):
+			raise NotStaticallyDeterminate()
+		return x
+
+
+class Stiffness(object):
+	"""
+	The factorized stiffness matrix of a structure, for the stiffness method
+
+	Unlike pin-jointed analysis, this can solve statically indeterminate
+	structures, by sharing load between redundant beams according to their
+	axial stiffness `modulus * area / length`. `areas` is either a single
+	area for every beam, or a `{beam: area}` dict. Only the relative stiffness
+	of the beams affects the tensions.
+
+	The factorization is reused by every `Loading` given this object. Raises
+	`NotStaticallyDeterminate` if the structure is a mechanism.
+	"""
+	def __init__(self, st, areas=1.0, modulus=1.0):
+		self.structure = st
+		self.compiled = compiled = _compiled(st)
+		self.areas = areas
+		self.modulus = modulus
+		dim = compiled.dimensions
+
+		if isinstance(areas, dict):
+			areas = np.array([areas[b] for b in compiled.beams], dtype=float)
+		self.stiffnesses = modulus * np.broadcast_to(areas, compiled.lengths.shape) / compiled.lengths
+
+		# each beam contributes k d d^T, with the sign depending on which ends
+		a_idx, b_idx = compiled.connectivity.T
+		a_dofs = a_idx[:,np.newaxis] * dim + np.arange(dim)
+		b_dofs = b_idx[:,np.newaxis] * dim + np.arange(dim)
+		d = compiled.directions
+		blocks = self.stiffnesses[:,np.newaxis,np.newaxis] * d[:,:,np.newaxis] * d[:,np.newaxis,:]
+
+		rows, cols, values = [], [], []
+		for r, c, sign in [(a_dofs, a_dofs, 1), (b_dofs, b_dofs, 1), (a_dofs, b_dofs, -1), (b_dofs, a_dofs, -1)]:
+			rows.append(np.broadcast_to(r[:,:,np.newaxis], blocks.shape).ravel())
+			cols.append(np.broadcast_to(c[:,np.newaxis,:], blocks.shape).ravel())
+			values.append(sign * blocks.ravel())
+
+		n_dofs = len(compiled.positions) * dim
+		matrix = _sparse_matrix(
+			np.concatenate(values), np.concatenate(rows), np.concatenate(cols), shape=(n_dofs, n_dofs)
+		)
+
+		# mounts do not move
+		self._free = np.flatnonzero(~np.repeat(compiled.mounts, dim))
+		matrix = matrix[self._free][:,self._free]
+
+		# the tensions must balance the load at every free joint
+		equilibrium = compiled.equilibrium_matrix()[0]
+		self._equilibrium = equilibrium[self._free][:,:len(compiled.beams)]
+
+		try:
+			self._factorization = _Factorization(matrix)
+		except NotStaticallyDeterminate:
+			raise NotStaticallyDeterminate(st)
+
+	def solve(self, forces):
+		"""
+		Find the displacements of the joints and tensions in the beams under a
+		`{joint: force}` dict, as arrays ordered like the compiled structure.
+
+		Raises `NotStaticallyDeterminate` if the tensions do not balance the
+		load, as for a mechanism, or a structure too badly conditioned for
+		the stiffness method.
+		"""
+		compiled = self.compiled
+		f = compiled.forces_array(forces).ravel()
+
+		# the residual of the displacements is dominated by the conditioning of
+		# the stiffness matrix, so the tensions are checked for equilibrium
+		# instead. A mechanism moves without bound, and balances nothing.
+		u = np.zeros_like(f)
+		u[self._free] = self._factorization.solve(f[self._free], check=False)
+		u = u.reshape(-1, compiled.dimensions)
+
+		a_idx, b_idx = compiled.connectivity.T
+		extension = np.einsum('ij,ij->i', u[b_idx] - u[a_idx], compiled.directions)
+		tensions = self.stiffnesses * extension
+
+		if not _satisfies(self._equilibrium.dot(tensions), -f[self._free], _term_size(self._equilibrium, tensions)):
+			raise NotStaticallyDeterminate(self.structure)
+		return u, tensions
+
 
 class Loading(object):
-	"""A loading configuration of a structure"""
-	def __init__(self, st, forces):
+	"""
+	A loading configuration of a structure
+
+	By default, forces are resolved joint by joint. Passing method="global"
+	instead solves the equilibrium equations for the whole structure at once,
+	which is much faster for large structures, and copes with structures in
+	which no single joint can be isolated. A `CompiledTruss` can only be
+	solved globally, which is the default for one.
+
+	Statically indeterminate structures can be solved with method="stiffness",
+	which needs the axial stiffness of every beam - pass a `Stiffness` to reuse
+	its factorization across load cases. Otherwise, every beam is given the
+	same stiffness.
+
+	Structures with a mirror plane (see `Truss.set_mirror`) are solved by
+	default with method="symmetric", which splits the loads into symmetric and
+	antisymmetric parts, and solves each on half of the unknowns. Symmetric
+	loads then only need one half-sized solve, and `mirrored` maps one beam of
+	each mirror image pair to the number of beams in the pair. The
+	factorization of each half is kept on the truss for later load cases
+	until a joint moves. If the joints have moved out of symmetry, this falls
+	back to a global solve.
+	"""
+	def __init__(self, st, forces, method=None, stiffness=None):
 		self.structure = st
 		self.tensions = {}
+		self.mirrored = None
+
+		self._version = getattr(st, 'geometry_version', None)
+		self._factorization = None
+		self._low_rank = None
+		self._forces = forces
+
+		if method is None:
+			if isinstance(st, CompiledTruss):
+				method = 'global'
+			elif st.mirror is not None:
+				method = 'symmetric'
+			else:
+				method = 'joint'
+		self._method = method
+
+		if method == 'joint':
+			if isinstance(st, CompiledTruss):
+				raise ValueError("A CompiledTruss can only be solved with method='global'")
+			self._solve_joints(forces)
+		elif method == 'global':
+			self._solve_global(forces)
+		elif method == 'symmetric':
+			self._solve_symmetric(forces)
+		elif method == 'stiffness':
+			self._solve_stiffness(forces, stiffness if stiffness is not None else Stiffness(st))
+		else:
+			raise ValueError("Unknown method {!r}".format(method))
+
+	def _solve_stiffness(self, forces, stiffness):
+		"""Solve for the displacements of the joints, and hence the tensions"""
+		st = self.structure
+		if stiffness.compiled is not _compiled(st):
+			raise ValueError("The stiffness matrix is not for the current geometry of this structure")
+
+		self._stiffness = stiffness
+		displacements, tensions = stiffness.solve(forces)
+		self.displacements = dict(zip(stiffness.compiled.joints, displacements))
+		self.tensions = dict(zip(stiffness.compiled.beams, tensions))
+
+	def _solve_global(self, forces):
+		"""Solve the equilibrium equations of every joint simultaneously"""
+		st = self.structure
+		compiled = _compiled(st)
+		matrix, joints, beams = compiled.equilibrium_matrix()
+
+		self._compiled_structure = compiled
+		self._rhs = -compiled.forces_array(forces).ravel()
+		self._low_rank = None
+
+		try:
+			self._factorization = _Factorization(matrix)
+			x = self._factorization.solve(self._rhs)
+		except NotStaticallyDeterminate:
+			raise NotStaticallyDeterminate(st)
+		self.tensions = dict(zip(beams, x[:len(beams)]))
+
+	def _solve_symmetric(self, forces):
+		"""Solve the symmetric and antisymmetric parts of the loading separately"""
+		st = self.structure
+		compiled = _compiled(st)
+		self.mirrored = None
+
+		# the halves are kept on the truss, for every load case and update
+		halves = st._mirror_halves
+		if halves is None or halves.mirror is not st.mirror:
+			halves = st._mirror_halves = _MirrorHalves(st.mirror, compiled)
+		if not halves.is_symmetric(compiled):
+			return self._solve_global(forces)
+		joint_images, beam_images = halves.images
+
+		if st.maxwell > 0:
+			raise NotStaticallyDeterminate(st)
+		beams = compiled.beams
+		f = compiled.forces_array(forces).ravel()
+		scale = max(np.abs(f).max(), 1)
+
+		self._factorization = None
+		self._low_rank = None
+
+		x = np.zeros(len(beams) + compiled.mounts.sum() * compiled.dimensions)
+		symmetric = True
+		for i, (dofs, unknowns) in enumerate(halves.bases):
+			part = dofs.T.dot(f)
+			if not part.size or np.abs(part).max() <= 1e-12 * scale:
+				continue
+			if i:
+				symmetric = False
+			try:
+				y = halves.factorization(i).solve(-part)
+			except NotStaticallyDeterminate:
+				raise NotStaticallyDeterminate(st)
+			x += unknowns.dot(y)
+
+		self.tensions = dict(zip(beams, x[:len(beams)]))
+		if symmetric:
+			self.mirrored = dict(
+				(beams[i], 1 if j == i else 2)
+				for i, j in enumerate(beam_images) if j >= i
+			)
+
+	def update(self, joint, pos):
+		"""
+		Move a joint, and update the tensions to match
+
+		Only the beams attached to the joint change direction, so this is much
+		cheaper than a new Loading. A global solve applies a low-rank update to
+		its existing factorization, and a joint-by-joint solve only repeats the
+		steps of the elimination plan which are affected by the move.
+		"""
+		st = self.structure
+		if isinstance(st, CompiledTruss):
+			raise TypeError("The joints of a CompiledTruss cannot be moved")
+		if st.geometry_version != self._version:
+			raise ValueError("The structure has moved since this loading was solved")
+
+		joint.pos = pos
+		self._version = st.geometry_version
 
+		if self._method == 'global':
+			self._update_global(joint)
+		elif self._method == 'symmetric':
+			self._solve_symmetric(self._forces)
+		elif self._method == 'stiffness':
+			old = self._stiffness
+			self._solve_stiffness(self._forces, Stiffness(st, old.areas, old.modulus))
+		else:
+			self._update_joints(joint)
+
+	def _update_global(self, joint):
+		"""Update a global solve after a joint has moved"""
+		if self._low_rank is None:
+			if self._factorization is None or not self._factorization._square:
+				self._solve_global(self._forces)
+				return
+			self._low_rank = _LowRankUpdate(self._factorization, self._compiled_structure, self._rhs)
+		low_rank = self._low_rank
+
+		# the factorization no longer matches the geometry
+		self._factorization = None
+
+		try:
+			x = low_rank.move(joint)
+		except NotStaticallyDeterminate:
+			raise NotStaticallyDeterminate(self.structure)
+
+		# once enough beams have moved, starting afresh is cheaper
+		if low_rank.rank > _LowRankUpdate.max_rank:
+			self._solve_global(self._forces)
+			return
+
+		self.tensions = dict(zip(self._compiled_structure.beams, x[:len(self.tensions)]))
+
+	def _update_joints(self, joint):
+		"""Update a joint-by-joint solve after a joint has moved"""
+		plan = self.structure._elimination_plan
+		zero = np.zeros(self.structure.dimensions)
+
+		# a step must be repeated if a beam at its joint has turned, or
+		# has a new tension
+		moved = set(joint.beams)
+		changed = set()
+		for step_joint, unsolved_beams in (plan or []):
+			if moved.isdisjoint(step_joint.beams) and changed.isdisjoint(step_joint.beams):
+				continue
+			if not self._solve_for(step_joint, self._forces.get(step_joint, zero), unsolved_beams):
+				break
+			changed.update(unsolved_beams)
+		else:
+			if plan is not None:
+				return
+
+		# no usable plan - start again
+		self.tensions = {}
+		self._solve_joints(self._forces)
+
+	def _factorized(self):
+		"""The factorized equilibrium matrix, which must be square"""
+		st = self.structure
+		if getattr(st, 'geometry_version', None) != self._version:
+			raise ValueError("The structure has moved since this loading was solved")
+
+		if self._factorization is None:
+			matrix, joints, beams = _compiled(st).equilibrium_matrix()
+			try:
+				self._factorization = _Factorization(matrix)
+			except NotStaticallyDeterminate:
+				raise NotStaticallyDeterminate(st)
+
+		if not self._factorization._square:
+			raise NotStaticallyDeterminate(st)
+		return self._factorization
+
+	def _tension_array(self, compiled):
+		return np.array([self.tensions[b] for b in compiled.beams], dtype=float)
+
+	def gradient(self, dJ_dt, dJ_dx=None):
+		"""
+		Find the gradient of an objective J(tensions, positions) with respect
+		to the position of every joint, using the adjoint method.
+
+		`dJ_dt` is a `{beam: dJ/dt}` dict of the partial derivatives with
+		respect to each tension, and `dJ_dx` an optional `{joint: dJ/dx}` dict
+		of the partial derivatives with respect to each position, at fixed
+		tension. Returns a `{joint: dJ/dx}` dict of total derivatives.
+
+		This costs one extra solve, reusing the factorization of a global
+		solve if there was one. The structure must be statically determinate.
+		"""
+		compiled = _compiled(self.structure)
+		factorization = self._factorized()
+
+		g = np.zeros(factorization.matrix.shape[1])
+		g[:len(compiled.beams)] = [dJ_dt.get(b, 0) for b in compiled.beams]
+
+		# J changes by -adjoint . (dA t) when the geometry changes
+		adjoint = factorization.solve_transpose(g)
+		derivative = compiled.equilibrium_derivative(self._tension_array(compiled))
+		grad = -derivative.T.dot(adjoint).reshape(-1, compiled.dimensions)
+
+		if dJ_dx is not None:
+			for joint, d in dJ_dx.items():
+				grad[compiled.index(joint)] += d
+
+		return dict(zip(compiled.joints, grad))
+
+	def tension_jacobian(self):
+		"""
+		Find the derivative of every tension with respect to every joint
+		position, as an array of shape `(n_beams, n_joints, dim)` ordered as
+		the `beams` and `joints` of the compiled structure.
+
+		This needs a solve per joint coordinate - for the gradient of a
+		single objective, `gradient` is much cheaper.
+		"""
+		compiled = _compiled(self.structure)
+		factorization = self._factorized()
+
+		derivative = compiled.equilibrium_derivative(self._tension_array(compiled))
+		if hasattr(derivative, 'toarray'):
+			derivative = derivative.toarray()
+
+		# A dt = -dA t
+		jacobian = -factorization.solve(derivative, check=False)[:len(compiled.beams)]
+		return jacobian.reshape(len(compiled.beams), -1, compiled.dimensions)
+
+	def _solve_joints(self, forces):
+		"""
+		Resolve forces one joint at a time, until all are solved
+
+		The order in which joints could be solved, and which beams were
+		unknown at each one, depends only on the topology - so it is recorded
+		on the structure the first time, and replayed on later solves.
+		"""
+		st = self.structure
+
+		if st._elimination_plan is not None:
+			if self._replay(st._elimination_plan, forces):
+				return
+			# degenerate geometry - fall back to searching for an order
+			self.tensions = {}
+
+		plan = []
 		fail_count = 0
 		to_solve = deque(st.joints)
 		while to_solve:
 			n = to_solve.pop()
-			if self._solve(n, forces.get(n, np.zeros(st.dimensions))):
+			if self._solve(n, forces.get(n, np.zeros(st.dimensions)), plan):
 				fail_count = 0
 			else:
 				fail_count += 1
 				to_solve.appendleft(n)
 
 			if fail_count > len(to_solve):
-				raise NotStaticallyDeterminate()
+				raise NotStaticallyDeterminate(st)
+
+		st._elimination_plan = plan
 
-	def _solve(self, joint, f):
-		"""Attempt to resolve forces at a single joint, if possible"""
+	def _replay(self, plan, forces):
+		"""Solve joints in the order given by a plan, returning False if any step fails"""
+		zero = np.zeros(self.structure.dimensions)
+		for joint, unsolved_beams in plan:
+			if not self._solve_for(joint, forces.get(joint, zero), unsolved_beams):
+				return False
+		return True
+
+	def _solve(self, joint, f, plan=None):
+		"""
+		Attempt to resolve forces at a single joint, if possible, recording
+		the step in the plan if it succeeds
+		"""
 		# nothing to resolve at mounts
 		if isinstance(joint, Mount):
 			return True
 
-		f = np.asarray(f)
+		# find unconstrained beams
+		unsolved_beams = [beam for beam in joint.beams if beam not in self.tensions]
+
+		if not self._solve_for(joint, f, unsolved_beams):
+			return False
+
+		if plan is not None:
+			plan.append((joint, unsolved_beams))
+		return True
+
+	def _solve_for(self, joint, f, unsolved_beams):
+		"""Resolve forces at a joint, given which beams have unknown tension"""
+		f = np.array(f, dtype=float)
 
 		# calculate direction vectors for beams
 		beam_dirs = {}
@@ -120,13 +1429,13 @@ class Loading(object):
 			else:
 				beam_dirs[beam] = -beam.direction
 
-		# find unconstrained beams
-		unsolved_beams = []
+		# include the forces from beams already solved
 		for beam in joint.beams:
-			if beam in self.tensions:
-				f += beam_dirs[beam] * self.tensions[beam]
-			else:
-				unsolved_beams.append(beam)
+			if beam not in unsolved_beams:
+				try:
+					f += beam_dirs[beam] * self.tensions[beam]
+				except KeyError:
+					return False
 
 		# not enough constraints solved
 		if len(unsolved_beams) > self.structure.dimensions:
@@ -162,3 +1471,158 @@ class Loading(object):
 			self.tensions[beam] = tension
 
 		return True
+
+
+class InfluenceMatrix(object):
+	"""
+	The linear map from joint forces to beam tensions, for a fixed geometry
+
+	This is computed once, after which any loading of the structure - or a
+	whole stack of loadings - costs a single matrix multiply. Force arrays are
+	indexed in the order of `joints`, and tension arrays in the order of
+	`beams`.
+	"""
+	def __init__(self, st):
+		self.structure = st
+		self._compiled = _compiled(st)
+		matrix, self.joints, self.beams = self._compiled.equilibrium_matrix()
+
+		n_dofs = matrix.shape[0]
+		try:
+			factorization = _Factorization(matrix)
+		except NotStaticallyDeterminate:
+			raise NotStaticallyDeterminate(st)
+		response = factorization.solve(np.eye(n_dofs), check=False)
+
+		# tension in each beam due to a unit force in each degree of freedom
+		self.matrix = -response[:len(self.beams)]
+
+		# a mechanism can only carry some loads - remember which ones
+		if factorization._square:
+			self._residual = None
+		else:
+			self._residual = matrix.dot(response) - np.eye(n_dofs)
+
+	def forces_array(self, forces):
+		"""
+		Convert a `{joint: force}` dict, or a list of them, into an array of
+		shape `(n_joints, dim)` or `(n_cases, n_joints, dim)`
+		"""
+		return self._compiled.forces_array(forces)
+
+	def solve(self, forces):
+		"""
+		Find the tensions for an array of joint forces of shape
+		`(..., n_joints, dim)`, returning an array of shape `(..., n_beams)`
+		"""
+		forces = np.asarray(forces, dtype=float)
+		shape = forces.shape[:-2]
+		f = forces.reshape(-1, self.matrix.shape[1])
+
+		if self._residual is not None and not _satisfies(f.dot(self._residual.T), np.zeros_like(f)):
+			raise NotStaticallyDeterminate(self.structure)
+
+		return f.dot(self.matrix.T).reshape(shape + (len(self.beams),))
+
+	def tensions(self, forces):
+		"""Find the tensions for a `{joint: force}` dict, as a `{beam: tension}` dict"""
+		return dict(zip(self.beams, self.solve(self.forces_array(forces))))
+
+	def envelope(self, forces):
+		"""
+		Find the minimum and maximum tension in each beam over a set of load
+		cases, given either as an array of shape `(n_cases, n_joints, dim)`, or
+		a list of `{joint: force}` dicts
+		"""
+		if not isinstance(forces, np.ndarray):
+			forces = self.forces_array(forces)
+		t = self.solve(forces)
+		return t.min(axis=0), t.max(axis=0)
+
+
+class BatchLoading(object):
+	"""
+	A loading of many geometries of the same structure, solved at once
+
+	`positions` is either an `(n_candidates, n_joints, dim)` array, with
+	joints in the order of the `joints` of the compiled structure, or a dict
+	mapping some joints to `(n_candidates, dim)` arrays of positions, with the
+	other joints staying where they are. `forces` is a `{joint: force}` dict,
+	or an array of shape `(n_joints, dim)` or `(n_candidates, n_joints, dim)`.
+
+	The results are arrays of shape `(n_candidates, n_beams)`, with beams in
+	the order of `beams`. Candidates which cannot be solved are marked as
+	False in `feasible`, and have tensions of nan.
+
+	Each candidate gets a dense equilibrium matrix, so this is intended for
+	sweeping the geometry of small structures.
+	"""
+	def __init__(self, st, positions, forces):
+		self.structure = st
+		compiled = _compiled(st)
+		self.joints = compiled.joints
+		self.beams = compiled.beams
+		dim = compiled.dimensions
+
+		if isinstance(positions, dict):
+			moved = dict((compiled.index(j), np.asarray(p, dtype=float)) for j, p in positions.items())
+			n = max(len(p) for p in moved.values())
+			positions = np.repeat(compiled.positions[np.newaxis], n, axis=0)
+			for i, p in moved.items():
+				positions[:,i] = p
+		self.positions = positions = np.asarray(positions, dtype=float)
+		n_candidates = len(positions)
+
+		if isinstance(forces, dict):
+			forces = compiled.forces_array(forces)
+		forces = np.broadcast_to(forces, positions.shape)
+
+		# geometry of every beam in every candidate
+		a_idx, b_idx = compiled.connectivity.T
+		diff = positions[:,b_idx] - positions[:,a_idx]
+		self.lengths = np.linalg.norm(diff, axis=-1)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			dirs = diff / self.lengths[...,np.newaxis]
+
+		# the same sparsity pattern as CompiledTruss.equilibrium_matrix
+		n_beams = len(b_idx)
+		a_dofs = a_idx[:,np.newaxis] * dim + np.arange(dim)
+		b_dofs = b_idx[:,np.newaxis] * dim + np.arange(dim)
+		beam_cols = np.repeat(np.arange(n_beams), dim)
+		mount_dofs = np.flatnonzero(compiled.mounts)[:,np.newaxis] * dim + np.arange(dim)
+		mount_cols = n_beams + np.arange(mount_dofs.size)
+
+		n_rows, n_cols = positions.shape[1] * dim, n_beams + mount_dofs.size
+		matrices = np.zeros((n_candidates, n_rows, n_cols))
+		matrices[:, a_dofs.ravel(), beam_cols] = dirs.reshape(n_candidates, -1)
+		matrices[:, b_dofs.ravel(), beam_cols] = -dirs.reshape(n_candidates, -1)
+		matrices[:, mount_dofs.ravel(), mount_cols] = 1
+
+		self.tensions = np.full((n_candidates, n_beams), np.nan)
+		self.feasible = np.zeros(n_candidates, dtype=bool)
+		if n_cols > n_rows or not n_candidates:
+			# redundant - no candidate can be solved
+			return
+
+		# a rank check on each candidate, to avoid solving singular ones
+		with np.errstate(invalid='ignore'):
+			s = np.linalg.svd(np.nan_to_num(matrices), compute_uv=False)
+		ok = np.all(np.isfinite(dirs), axis=(1, 2)) & (s[:,-1] > s[:,0] * max(n_rows, n_cols) * np.finfo(float).eps)
+
+		a = matrices[ok]
+		b = -forces[ok].reshape(-1, n_rows, 1)
+		if n_rows == n_cols:
+			x = np.linalg.solve(a, b)
+		else:
+			# mechanisms - solve in a least-squares sense, then check that the
+			# load can actually be carried
+			at = a.transpose(0, 2, 1)
+			x = np.linalg.solve(np.matmul(at, a), np.matmul(at, b))
+			scale = np.maximum(np.abs(b).max(axis=(1, 2)), 1)
+			residual = np.abs(np.matmul(a, x) - b).max(axis=(1, 2))
+			carried = residual <= 1e-8 * scale + 1e-5 * np.abs(b).max(axis=(1, 2))
+			ok[ok] = carried
+			x = x[carried]
+
+		self.feasible = ok
+		self.tensions[ok] = x[:,:n_beams,0]
@@ -0,0 +1,437 @@
+"""
+Searches over the positions of some of the joints of a truss, either
+exhaustive or coarse-to-fine, spread over a pool of processes
+"""
+import heapq
+import json
+import multiprocessing
+import os
+import pickle
+import numpy as np
+
+from structure import Loading, NotStaticallyDeterminate
+
+try:
+	from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+except ImportError:
+	ProcessPoolExecutor = None
+
+
+class Sweep(object):
+	"""
+	Every combination of candidate positions for some of the joints of a truss,
+	scored by a cost function of the Loading under some forces. Geometries which
+	Loading cannot solve, or which have an infinite cost, are skipped.
+
+	`candidates` maps each free joint to an (n, dim) array of positions to try.
+	`cost` is called with each Loading, and must be picklable - a function at
+	the top level of a module, such as `sdp.get_cost`.
+
+	To prune the sweep, `lower_bound` can be given, which is called with an
+	(n, n_beams) array of the lengths of the beams of n candidates, in the
+	order of the compiled structure, and returns a lower bound on the cost of
+	each. Candidates whose bound is more than the kth best cost so far are
+	skipped without being solved, as are whole chunks of them at once. `cost`
+	is then also passed that cost to beat as `bound`, and may return inf as
+	soon as it knows it cannot beat it.
+	"""
+	def __init__(self, st, forces, candidates, cost, lower_bound=None):
+		self.structure = st
+		self.forces = forces
+		self.joints = list(candidates)
+		self.candidates = [np.asarray(candidates[j], dtype=float) for j in self.joints]
+		self.cost = cost
+		self.lower_bound = lower_bound
+
+		self.shape = tuple(len(c) for c in self.candidates)
+		self.size = int(np.prod(self.shape))
+
+	def __len__(self):
+		return self.size
+
+	def positions(self, index):
+		"""The positions of the free joints for a flat index into the sweep"""
+		return dict(
+			(joint, c[i])
+			for joint, c, i in zip(self.joints, self.candidates, np.unravel_index(index, self.shape))
+		)
+
+	def run(self, k=10, workers=None, chunk_size=256, store=None):
+		"""
+		Evaluate every candidate, returning the k cheapest as a list of
+		(cost, positions) tuples, cheapest first. Ties go to the candidate
+		earliest in the sweep.
+
+		The structure is sent to each worker once, and only chunk bounds and the
+		best k of each chunk pass between processes, so memory use does not grow
+		with the size of the sweep. With `workers=1`, or without
+		concurrent.futures, the sweep runs in this process.
+
+		If `store` is a directory, the cost of every candidate is also written
+		there as each chunk finishes, as a SweepStore. Running the same sweep
+		with the same store again resumes it, skipping the chunks already
+		finished.
+		"""
+		if workers is None:
+			workers = multiprocessing.cpu_count()
+
+		geometry = None
+		if self.lower_bound is not None:
+			compiled = self.structure.compile()
+			geometry = compiled.positions, compiled.connectivity, [compiled.index(j) for j in self.joints]
+		state = (self.structure, self.forces, self.joints, self.candidates, self.cost, self.lower_bound, geometry)
+
+		best = []
+		chunks = self._chunks(chunk_size)
+		if store is not None:
+			store = SweepStore.open(store, self, chunk_size)
+			best = store.best(k)
+			chunks = (
+				chunk for chunk in chunks
+				if not store.done[chunk[0] // chunk_size]
+			)
+
+		def merge(best, start, stop, result):
+			if store is not None:
+				result, costs = result
+				store.write(start, stop, costs)
+			return heapq.nsmallest(k, best + result)
+
+		record = store is not None
+		if workers == 1 or ProcessPoolExecutor is None:
+			# work on a copy, to leave the joints of our structure where they were
+			_start_worker(pickle.loads(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+			try:
+				for chunk in chunks:
+					best = merge(best, *chunk, result=_sweep_chunk(k, _incumbent(best, k), *chunk, record=record))
+			finally:
+				_start_worker(None)
+		else:
+			pool = _pool(workers, state)
+			try:
+				pending = {}
+				for chunk in chunks:
+					# keep a bounded number of chunks in flight
+					if len(pending) >= 2 * workers:
+						done, _ = wait(pending, return_when=FIRST_COMPLETED)
+						for f in done:
+							best = merge(best, *pending.pop(f), result=f.result())
+					f = pool.submit(_sweep_chunk, k, _incumbent(best, k), *chunk, record=record)
+					pending[f] = chunk
+
+				for f in wait(pending)[0]:
+					best = merge(best, *pending[f], result=f.result())
+			finally:
+				pool.shutdown()
+				_start_worker(None)
+
+		return [(cost, self.positions(index)) for cost, index in best]
+
+	def _chunks(self, chunk_size):
+		start = 0
+		while start < self.size:
+			yield start, min(start + chunk_size, self.size)
+			start += chunk_size
+
+class SweepStore(object):
+	"""
+	The cost of every candidate of a Sweep, kept in a directory as the sweep
+	runs, so that it can be resumed after a crash, and its results queried
+	without evaluating them again.
+
+	The directory holds the candidates of each joint, a memory-mapped array of
+	the cost of every candidate by its flat index into the sweep, and one of
+	which chunks are finished. A chunk is only marked finished once its costs
+	are flushed to disk. Costs are inf for infeasible candidates, and nan for
+	those not evaluated - in unfinished chunks, or pruned by a lower bound.
+	"""
+	def __init__(self, path, mode='r'):
+		with open(os.path.join(path, 'meta.json')) as f:
+			meta = json.load(f)
+		self.path = path
+		self.joints = meta['joints']
+		self.shape = tuple(meta['shape'])
+		self.size = int(np.prod(self.shape))
+		self.chunk_size = meta['chunk_size']
+		self.candidates = [
+			np.load(os.path.join(path, 'candidates-{}.npy'.format(i)))
+			for i in range(len(self.joints))
+		]
+		self.costs = np.load(os.path.join(path, 'costs.npy'), mmap_mode=mode)
+		self.done = np.load(os.path.join(path, 'done.npy'), mmap_mode=mode)
+
+	@classmethod
+	def open(cls, path, sweep, chunk_size):
+		"""Open the store of a sweep for writing, creating it if needed"""
+		joints = [getattr(j, 'name', str(j)) for j in sweep.joints]
+		if not os.path.exists(os.path.join(path, 'meta.json')):
+			cls._create(path, joints, sweep.candidates, chunk_size)
+
+		store = cls(path, mode='r+')
+		if (
+			store.joints != joints or
+			store.shape != sweep.shape or
+			store.chunk_size != chunk_size or
+			not all(np.array_equal(a, b) for a, b in zip(store.candidates, sweep.candidates))
+		):
+			raise ValueError("The store at {!r} is of a different sweep".format(path))
+		return store
+
+	@staticmethod
+	def _create(path, joints, candidates, chunk_size):
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		shape = tuple(len(c) for c in candidates)
+		size = int(np.prod(shape))
+
+		for i, c in enumerate(candidates):
+			np.save(os.path.join(path, 'candidates-{}.npy'.format(i)), c)
+		costs = np.lib.format.open_memmap(os.path.join(path, 'costs.npy'), mode='w+', dtype=float, shape=(size,))
+		costs[:] = np.nan
+		costs.flush()
+		np.save(os.path.join(path, 'done.npy'), np.zeros(-(-size // chunk_size), dtype=bool))
+		del costs
+
+		# written last, so that a store is never found half made
+		with open(os.path.join(path, 'meta.json'), 'w') as f:
+			json.dump(dict(joints=joints, shape=shape, chunk_size=chunk_size), f)
+
+	def write(self, start, stop, costs):
+		"""Record the costs of a finished chunk"""
+		self.costs[start:stop] = costs
+		self.costs.flush()
+		self.done[start // self.chunk_size] = True
+		self.done.flush()
+
+	@property
+	def finished(self):
+		"""Whether each candidate is in a finished chunk"""
+		return np.repeat(self.done, self.chunk_size)[:self.size]
+
+	@property
+	def feasible(self):
+		"""Whether each candidate was evaluated and found a finite cost"""
+		return np.isfinite(self.costs)
+
+	def positions(self, indices):
+		"""
+		The positions of the free joints for flat indices into the sweep, as a
+		dict of arrays keyed by joint name
+		"""
+		return dict(
+			(joint, c[i])
+			for joint, c, i in zip(self.joints, self.candidates, np.unravel_index(indices, self.shape))
+		)
+
+	def best(self, k=10, costs=None):
+		"""
+		The k cheapest (cost, index) pairs found so far, cheapest first, with
+		ties going to the lowest index. To re-rank the sweep, pass `costs`, an
+		array of another cost for every candidate.
+		"""
+		if costs is None:
+			costs = self.costs
+		indices = np.flatnonzero(self.feasible & np.isfinite(costs))
+		costs = np.asarray(costs)[indices]
+		if k < len(indices):
+			# cut down to the candidates tied with or better than the kth
+			kth = np.partition(costs, k - 1)[k - 1]
+			keep = costs <= kth
+			indices, costs = indices[keep], costs[keep]
+		order = np.lexsort((indices, costs))[:k]
+		return [(float(costs[i]), int(indices[i])) for i in order]
+
+def optimize(st, forces, bounds, cost, points=5, levels=6, keep=3, polish='pattern', tol=1e-3, workers=1, lower_bound=None):
+	"""
+	Find the cheapest positions for some of the joints of a truss, starting
+	from a coarse grid and repeatedly refining around the best candidates.
+
+	`bounds` maps each free joint to a pair of (lower, upper) corners of the box
+	it may move in - an axis with equal bounds is held fixed. Each level sweeps
+	a grid of `points` per axis over a box around the best candidate so far,
+	one grid spacing to either side, so that every level shrinks the spacing
+	by a factor of (points - 1) / 2. The first of these is swept around each
+	of the `keep` best candidates of the coarse grid instead, in case the
+	coarse grid misjudged which of them is best.
+
+	With the defaults, `sdp.optimize_normal(adaptive=True)` evaluates about
+	1,040 designs, against 9,261 for its fixed grid, and finds a cheaper one.
+
+	The best candidate is then polished, either by a pattern search
+	(`polish='pattern'`), or by Nelder-Mead from scipy
+	(`polish='nelder-mead'`), until the step is below `tol`. Returns the
+	cost and a dict of the positions of the free joints. `lower_bound` is used
+	to prune each level, as in Sweep.
+	"""
+	joints = list(bounds)
+	lower = [np.asarray(bounds[j][0], dtype=float) for j in joints]
+	upper = [np.asarray(bounds[j][1], dtype=float) for j in joints]
+
+	def grid(lo, hi):
+		axes = [np.linspace(l, h, points if h > l else 1) for l, h in zip(lo, hi)]
+		return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(axes))
+
+	def spacing(lo, hi):
+		return (hi - lo) / (points - 1)
+
+	best = Sweep(st, forces, dict(
+		(j, grid(lo, hi)) for j, lo, hi in zip(joints, lower, upper)
+	), cost, lower_bound).run(k=keep, workers=workers)
+	if not best:
+		raise ValueError("No feasible design within the bounds")
+	steps = [spacing(lo, hi) for lo, hi in zip(lower, upper)]
+
+	for level in range(1, levels):
+		results = list(best)
+		for c, positions in best:
+			boxes = [
+				(np.maximum(positions[j] - step, lo), np.minimum(positions[j] + step, hi))
+				for j, step, lo, hi in zip(joints, steps, lower, upper)
+			]
+			results += Sweep(st, forces, dict(
+				(j, grid(lo, hi)) for j, (lo, hi) in zip(joints, boxes)
+			), cost, lower_bound).run(k=1, workers=workers)
+
+		best = [min(results, key=lambda r: r[0])]
+		steps = [2 * step / (points - 1) for step in steps]
+
+	c, positions = best[0]
+	if polish is None:
+		return c, positions
+
+	# polish over the free coordinates, on a copy of the structure
+	# the forces are keyed by joint, so copy them along with the joints
+	st_, joints_, forces_ = pickle.loads(pickle.dumps((st, joints, forces), pickle.HIGHEST_PROTOCOL))
+	sizes = np.cumsum([0] + [len(lo) for lo in lower])
+	lower, upper = np.concatenate(lower), np.concatenate(upper)
+	free = upper > lower
+	fixed = np.concatenate([positions[j] for j in joints])
+
+	def unflatten(x):
+		full = fixed.copy()
+		full[free] = x
+		return [full[a:b] for a, b in zip(sizes[:-1], sizes[1:])]
+
+	def evaluate(x):
+		if (x < lower[free]).any() or (x > upper[free]).any():
+			return np.inf
+		for joint, pos in zip(joints_, unflatten(x)):
+			joint.pos = pos
+		try:
+			loading = Loading(st_, forces_)
+		except NotStaticallyDeterminate:
+			return np.inf
+		return cost(loading)
+
+	x = fixed[free]
+	if polish == 'pattern':
+		x, c = _pattern_search(evaluate, x, c, np.concatenate(steps)[free], tol)
+	elif polish == 'nelder-mead':
+		import scipy.optimize
+		result = scipy.optimize.minimize(evaluate, x, method='Nelder-Mead', options=dict(xatol=tol, fatol=0))
+		if result.fun < c:
+			x, c = result.x, result.fun
+	else:
+		raise ValueError("Unknown polish {!r}".format(polish))
+
+	return c, dict(zip(joints, unflatten(x)))
+
+def _pattern_search(f, x, fx, step, tol):
+	"""Minimize f by trying steps along each axis, halving them when none help"""
+	step = step.copy()
+	while (step > tol).any():
+		for i in np.flatnonzero(step > tol):
+			for sign in (1, -1):
+				y = x.copy()
+				y[i] += sign * step[i]
+				fy = f(y)
+				if fy < fx:
+					x, fx = y, fy
+					break
+			else:
+				continue
+			break
+		else:
+			step /= 2
+	return x, fx
+
+def _incumbent(best, k):
+	"""The cost a candidate has to beat to make the best k"""
+	return best[-1][0] if len(best) == k else np.inf
+
+def _pool(workers, state):
+	try:
+		return ProcessPoolExecutor(workers, initializer=_start_worker, initargs=(state,))
+	except TypeError:
+		# older backports of concurrent.futures have no initializer, but fork
+		# their workers, which then inherit the state
+		_start_worker(state)
+		return ProcessPoolExecutor(workers)
+
+
+# the sweep being run by this worker process
+_state = None
+
+def _start_worker(state):
+	global _state
+	_state = state
+
+def _sweep_chunk(k, bound, start, stop, record=False):
+	"""
+	The k cheapest (cost, index) pairs from one chunk of the sweep, which cost
+	no more than bound. With `record`, also returns an array of the cost of
+	every candidate in the chunk, as stored by SweepStore.
+	"""
+	st, forces, joints, candidates, cost, lower_bound, geometry = _state
+	shape = tuple(len(c) for c in candidates)
+	indices = np.unravel_index(np.arange(start, stop), shape)
+	costs = np.full(stop - start, np.nan)
+
+	if lower_bound is not None:
+		positions, connectivity, moved = geometry
+		positions = np.repeat(positions[np.newaxis], stop - start, axis=0)
+		for i, c, idx in zip(moved, candidates, indices):
+			positions[:,i] = c[idx]
+		a, b = connectivity.T
+		bounds = lower_bound(np.linalg.norm(positions[:,b] - positions[:,a], axis=-1))
+		if (bounds > bound).all():
+			return ([], costs) if record else []
+	else:
+		bounds = np.full(stop - start, -np.inf)
+
+	# a heap of the k best so far, with the worst at the top
+	best = []
+	for n, index in enumerate(range(start, stop)):
+		if len(best) == k:
+			bound = min(bound, -best[0][0])
+		if bounds[n] > bound:
+			continue
+
+		for joint, c, idx in zip(joints, candidates, indices):
+			joint.pos = c[idx[n]]
+
+		try:
+			loading = Loading(st, forces)
+		except NotStaticallyDeterminate:
+			costs[n] = np.inf
+			continue
+
+		if lower_bound is None:
+			value = cost(loading)
+		else:
+			value = cost(loading, bound=bound)
+		if not np.isfinite(value):
+			# an early exit only says the candidate could not beat the bound
+			if bound == np.inf:
+				costs[n] = np.inf
+			continue
+		costs[n] = value
+
+		entry = (-value, -index)
+		if len(best) < k:
+			heapq.heappush(best, entry)
+		elif entry > best[0]:
+			heapq.heapreplace(best, entry)
+
+	best = sorted((-value, -index) for value, index in best)
+	return (best, costs) if record else best